@@ -34,9 +34,563 @@
 ################################################################################
 import re
 import time
+import array
+import bisect
+import errno
+import urlparse
+import random
 import fcntl
 import struct
+import select
 import socket
+import threading
+import collections
+import SocketServer
+import BaseHTTPServer
+import xml.sax.saxutils as saxutils
+
+# ConnectionPool {
+class ConnectionPool(object):
+    """
+    Keeps idle keep-alive TCP connections to each device so consecutive SOAP
+    calls reuse one connection instead of paying for a new handshake.
+    """
+
+    def __init__(self, max_per_host=2, idle_timeout=30.0, max_idle=256):
+        """
+        Initialize the pool. At most MAX_PER_HOST idle connections are kept for
+        each device and connections idle for IDLE_TIMEOUT seconds are dropped.
+        No more than MAX_IDLE are kept in all, so a large fleet doesn't use up
+        the process's file descriptors, the least recently used go first.
+        """
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self.max_idle = max_idle
+        self.idle = {}
+        # Every idle connection -> its key, least recently used first.
+        self.lru = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def connect(ip, port, timeout):
+        """
+        Socket factory. Returns a new TCP connection to IP:PORT configured for
+        talking to a Wemo.
+        """
+        # Wemo commands are sent over TCP
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_TCP)
+        # Allow the kernel to reuse the addr without TIME_WAIT expiring
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        # The requests are small, don't let Nagle hold them back.
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.settimeout(timeout)
+        try:
+            sock.connect((ip, port))
+        except socket.error:
+            sock.close()
+            raise
+        return sock
+
+    @staticmethod
+    def is_stale(sock):
+        """
+        An idle connection should have nothing to read. If it is readable the
+        device has either closed it or sent something unexpected.
+        """
+        try:
+            sock.setblocking(0)
+            try:
+                sock.recv(1, socket.MSG_PEEK)
+            finally:
+                sock.setblocking(1)
+        except socket.error as err:
+            return err.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK)
+        return True
+
+    def acquire(self, ip, port, timeout):
+        """
+        Returns a (socket, reused) tuple for IP:PORT. An idle connection is
+        handed out when one is available, otherwise a new one is made.
+        """
+        key = (ip, port)
+        now = time.time()
+        stale = []
+        sock = None
+        with self.lock:
+            conns = self.idle.get(key, [])
+            while conns:
+                conn, stamp = conns.pop()
+                del self.lru[conn]
+                if now - stamp < self.idle_timeout:
+                    sock = conn
+                    break
+                stale.append(conn)
+
+        for conn in stale:
+            conn.close()
+
+        if sock is not None and not ConnectionPool.is_stale(sock):
+            sock.settimeout(timeout)
+            return sock, True
+        if sock is not None:
+            sock.close()
+        return ConnectionPool.connect(ip, port, timeout), False
+
+    def release(self, ip, port, sock):
+        """
+        Returns SOCK to the pool. It is closed instead if the device already has
+        a full set of idle connections. When the pool is full the least recently
+        used connection is closed to make room.
+        """
+        evicted = None
+        with self.lock:
+            conns = self.idle.setdefault((ip, port), [])
+            if len(conns) >= self.max_per_host:
+                evicted = sock
+            else:
+                conns.append((sock, time.time()))
+                self.lru[sock] = (ip, port)
+                if len(self.lru) > self.max_idle:
+                    evicted, key = self.lru.popitem(last=False)
+                    self.idle[key] = [(conn, stamp) for conn, stamp in self.idle[key]
+                                      if conn is not evicted]
+                    if not self.idle[key]:
+                        del self.idle[key]
+        if evicted is not None:
+            evicted.close()
+
+    def evict_idle(self):
+        """
+        Closes every connection that has been idle longer than idle_timeout.
+        """
+        now = time.time()
+        stale = []
+        with self.lock:
+            for key in list(self.idle):
+                fresh = []
+                for conn, stamp in self.idle[key]:
+                    if now - stamp < self.idle_timeout:
+                        fresh.append((conn, stamp))
+                    else:
+                        stale.append(conn)
+                        del self.lru[conn]
+                if fresh:
+                    self.idle[key] = fresh
+                else:
+                    del self.idle[key]
+        for conn in stale:
+            conn.close()
+
+    def close_all(self):
+        """
+        Closes every idle connection in the pool.
+        """
+        with self.lock:
+            conns = [conn for key in self.idle for conn, stamp in self.idle[key]]
+            self.idle = {}
+            self.lru.clear()
+        for conn in conns:
+            conn.close()
+
+#} End of ConnectionPool
+
+
+# Patterns for the headers of SSDP responses.
+LOCATION_RE = re.compile(r'^location:\s*(.*)$', re.IGNORECASE | re.MULTILINE)
+ST_RE = re.compile(r'^st:\s*(.*)$', re.IGNORECASE | re.MULTILINE)
+USN_RE = re.compile(r'^usn:\s*(uuid:[^:\s]*)', re.IGNORECASE | re.MULTILINE)
+
+# Patterns for GENA subscription responses and event messages.
+SID_RE = re.compile(r'^sid:\s*(\S+)', re.IGNORECASE | re.MULTILINE)
+SUB_TIMEOUT_RE = re.compile(r'^timeout:\s*second-(\d+)', re.IGNORECASE | re.MULTILINE)
+BINARY_STATE_RE = re.compile(r'<BinaryState>(.*?)</BinaryState>', re.IGNORECASE)
+
+# Patterns for HTTP response headers and SOAP response fields.
+CONTENT_LENGTH_RE = re.compile(r'^content-length:\s*(\d+)', re.IGNORECASE | re.MULTILINE)
+CHUNKED_RE = re.compile(r'^transfer-encoding:.*chunked', re.IGNORECASE | re.MULTILINE)
+CONNECTION_CLOSE_RE = re.compile(r'^connection:\s*close', re.IGNORECASE | re.MULTILINE)
+FRIENDLY_NAME_RE = re.compile(r'<FriendlyName>(.*?)</FriendlyName>', re.IGNORECASE)
+
+# Patterns for the fields of a device description (setup.xml).
+DEVICE_TYPE_RE = re.compile(r'<deviceType>(.*?)</deviceType>', re.IGNORECASE)
+UDN_RE = re.compile(r'<UDN>(.*?)</UDN>', re.IGNORECASE)
+
+# Patterns for the bridge1 service of a Link. The device and status lists come
+# as escaped XML inside the SOAP response.
+DEVICE_LISTS_RE = re.compile(r'<DeviceLists>(.*?)</DeviceLists>', re.IGNORECASE | re.DOTALL)
+DEVICE_STATUS_LIST_RE = re.compile(r'<DeviceStatusList>(.*?)</DeviceStatusList>', re.IGNORECASE | re.DOTALL)
+DEVICE_INFO_RE = re.compile(r'<DeviceInfo>(.*?)</DeviceInfo>', re.IGNORECASE | re.DOTALL)
+DEVICE_STATUS_RE = re.compile(r'<DeviceStatus>(.*?)</DeviceStatus>', re.IGNORECASE | re.DOTALL)
+DEVICE_ID_RE = re.compile(r'<DeviceID[^>]*>(.*?)</DeviceID>', re.IGNORECASE)
+CAPABILITY_ID_RE = re.compile(r'<CapabilityIDs?>(.*?)</CapabilityIDs?>', re.IGNORECASE)
+CAPABILITY_VALUE_RE = re.compile(r'<CapabilityValue>(.*?)</CapabilityValue>', re.IGNORECASE)
+INSIGHT_PARAMS_RE = re.compile(r'<InsightParams>(.*?)</InsightParams>', re.IGNORECASE)
+CURRENT_STATE_RE = re.compile(r'<CurrentState>(.*?)</CurrentState>', re.IGNORECASE)
+ERROR_DEVICE_IDS_RE = re.compile(r'<ErrorDeviceIDs>(.*?)</ErrorDeviceIDs>', re.IGNORECASE)
+
+
+# xml_field(){
+def xml_field(pattern, text):
+    """
+    Returns the text PATTERN captures in TEXT, or '' if it isn't there.
+    """
+    found = pattern.search(text)
+    if found:
+        return found.group(1).strip()
+    return ''
+#} End of xml_field()
+
+
+# run_concurrently(){
+def run_concurrently(func, items, max_workers=8):
+    """
+    Calls FUNC on every element of ITEMS using at most MAX_WORKERS threads. Returns
+    a list of (item, result, error) tuples in the same order as ITEMS. ERROR is the
+    exception raised by FUNC, or None when the call succeeded.
+    """
+    items = list(items)
+    results = [None] * len(items)
+    pending = collections.deque(range(len(items)))
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                if not pending:
+                    return
+                index = pending.popleft()
+            item = items[index]
+            try:
+                results[index] = (item, func(item), None)
+            except Exception as err:
+                results[index] = (item, None, err)
+
+    # Don't bother with threads for a single item.
+    if len(items) <= 1:
+        worker()
+        return results
+
+    workers = []
+    for i in range(min(max_workers, len(items))):
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+        workers.append(thread)
+    for thread in workers:
+        thread.join()
+    return results
+#} End of run_concurrently()
+
+
+# expand_ranges(){
+def expand_ranges(ranges):
+    """
+    Returns the host addresses in RANGES, a list of CIDR blocks such as
+    '192.168.1.0/24' or single addresses, without duplicates. The network and
+    broadcast addresses of each block are left out.
+    """
+    hosts = []
+    seen = set()
+    for block in ranges:
+        addr, _, bits = block.strip().partition('/')
+        bits = int(bits) if bits else 32
+        if not 0 <= bits <= 32:
+            raise ValueError("Bad CIDR block: %s" % block)
+
+        mask = (0xffffffff << (32 - bits)) & 0xffffffff
+        first = struct.unpack('!I', socket.inet_aton(addr))[0] & mask
+        last = first | (~mask & 0xffffffff)
+        if bits < 31:
+            first, last = first + 1, last - 1
+
+        for host in xrange(first, last + 1):
+            if host not in seen:
+                seen.add(host)
+                hosts.append(socket.inet_ntoa(struct.pack('!I', host)))
+    return hosts
+#} End of expand_ranges()
+
+
+class DeviceDown(socket.error):
+    """
+    Raised instead of calling a device that has been failing.
+    """
+    pass
+
+
+
+# DeviceHealth {
+class DeviceHealth(object):
+    """
+    Tracks how a device has been responding. Timeouts follow the round trip
+    times seen recently instead of one fixed value. After repeated failures the
+    circuit opens and calls fail at once, until a single probe call is let
+    through after open_time seconds and succeeds.
+    """
+
+    # Number of round trip times kept.
+    samples = 32
+
+    # Timeouts are a multiple of the 95th percentile round trip time, within
+    # these bounds.
+    rtt_factor = 4.0
+    min_timeout = 0.5
+    max_timeout = 5.0
+
+    # Failed calls in a row that open the circuit, and how long it stays open.
+    failure_threshold = 3
+    open_time = 30.0
+
+    __slots__ = ('default_timeout', 'rtts', 'failures', 'open_until', 'probing', 'lock')
+
+    def __init__(self, default_timeout):
+        """
+        Initialize the health of a device. DEFAULT_TIMEOUT is used until there are
+        enough round trip times to go by.
+        """
+        self.default_timeout = default_timeout
+        self.rtts = collections.deque(maxlen=self.samples)
+        self.failures = 0
+        self.open_until = 0
+        self.probing = False
+        self.lock = threading.Lock()
+
+    def timeout(self):
+        """
+        Returns the timeout for the next call.
+        """
+        rtts = sorted(self.rtts)
+        if len(rtts) < 5:
+            return self.default_timeout
+        p95 = rtts[int(0.95 * (len(rtts) - 1))]
+        return min(self.max_timeout, max(self.min_timeout, p95 * self.rtt_factor))
+
+    def is_down(self):
+        """
+        Returns True while the circuit is open.
+        """
+        return self.open_until != 0
+
+    def probe_due(self):
+        """
+        Returns True if the circuit is open and ready for a probe call.
+        """
+        return self.open_until != 0 and not self.probing and time.time() >= self.open_until
+
+    def allow(self):
+        """
+        Returns True if a call may be made. While the circuit is open only one
+        probe is allowed, once open_time has passed.
+        """
+        with self.lock:
+            if self.open_until == 0:
+                return True
+            if self.probing or time.time() < self.open_until:
+                return False
+            self.probing = True
+            return True
+
+    def success(self, rtt):
+        """
+        Records a call that took RTT seconds, this closes the circuit.
+        """
+        with self.lock:
+            self.rtts.append(rtt)
+            self.failures = 0
+            self.open_until = 0
+            self.probing = False
+
+    def failure(self):
+        """
+        Records a failed call, the circuit opens after failure_threshold of them.
+        """
+        with self.lock:
+            self.failures += 1
+            self.probing = False
+            if self.failures >= self.failure_threshold:
+                self.open_until = time.time() + self.open_time
+
+#} End of DeviceHealth
+
+
+
+# Metrics {
+class Metrics(object):
+    """
+    Counters, gauges and latency histograms for the library and the daemon.
+    Recording a value costs a dict lookup and a few additions, so it is always
+    on. The values can be read as a dict or in the Prometheus text format.
+    """
+
+    # Upper bounds of the histogram buckets, in seconds.
+    buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self):
+        # (name, labels) -> value, labels is a tuple of (label, value) pairs.
+        self.counters = {}
+        self.gauges = {}
+        # (name, labels) -> [count per bucket..., count over the last bucket, sum]
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def inc(self, name, labels=(), value=1):
+        """
+        Adds VALUE to the counter NAME.
+        """
+        key = (name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, labels=(), value=0):
+        """
+        Sets the gauge NAME to VALUE.
+        """
+        with self.lock:
+            self.gauges[(name, labels)] = value
+
+    def observe(self, name, labels=(), value=0.0):
+        """
+        Records VALUE, in seconds, in the histogram NAME.
+        """
+        key = (name, labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = self.histograms[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            hist[index] += 1
+            hist[-1] += value
+
+    @staticmethod
+    def format_name(name, labels):
+        """
+        Returns NAME{label="value",...}. Backslashes, double quotes and newlines
+        in the values are escaped, as the text format requires.
+        """
+        if not labels:
+            return name
+        return '%s{%s}' % (name, ','.join('%s="%s"' % (label, Metrics.escape(value))
+                                          for label, value in labels))
+
+    @staticmethod
+    def escape(value):
+        """
+        Returns the label VALUE as an escaped UTF-8 string.
+        """
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    def snapshot(self):
+        """
+        Returns the current values as a dict. Histograms are summarized by their
+        count, sum and cumulative bucket counts.
+        """
+        with self.lock:
+            counters = dict(self.counters)
+            gauges = dict(self.gauges)
+            histograms = dict((key, hist[:]) for key, hist in self.histograms.items())
+
+        stats = { "counters": {}, "gauges": {}, "histograms": {} }
+        for key, value in counters.items():
+            stats["counters"][Metrics.format_name(*key)] = value
+        for key, value in gauges.items():
+            stats["gauges"][Metrics.format_name(*key)] = value
+        for key, hist in histograms.items():
+            count = sum(hist[:-1])
+            stats["histograms"][Metrics.format_name(*key)] = {
+                "count": count,
+                "sum": hist[-1],
+                "buckets": dict((str(bound), sum(hist[:i + 1]))
+                                for i, bound in enumerate(self.buckets)),
+            }
+        return stats
+
+    def render(self):
+        """
+        Returns the current values in the Prometheus text exposition format.
+        """
+        with self.lock:
+            counters = sorted(self.counters.items())
+            gauges = sorted(self.gauges.items())
+            histograms = sorted((key, hist[:]) for key, hist in self.histograms.items())
+
+        lines = []
+        typed = set()
+        for kind, items in (('counter', counters), ('gauge', gauges)):
+            for (name, labels), value in items:
+                if name not in typed:
+                    typed.add(name)
+                    lines.append('# TYPE %s %s' % (name, kind))
+                lines.append('%s %s' % (Metrics.format_name(name, labels), value))
+
+        for (name, labels), hist in histograms:
+            if name not in typed:
+                typed.add(name)
+                lines.append('# TYPE %s histogram' % name)
+            total = 0
+            for bound, count in zip(self.buckets + ('+Inf',), hist[:-1]):
+                total += count
+                lines.append('%s %d' % (Metrics.format_name(name + '_bucket',
+                                                            labels + (('le', bound),)), total))
+            lines.append('%s %s' % (Metrics.format_name(name + '_sum', labels), hist[-1]))
+            lines.append('%s %d' % (Metrics.format_name(name + '_count', labels), total))
+        return '\n'.join(lines) + '\n'
+
+#} End of Metrics
+
+# Metrics shared by everything in the process.
+metrics = Metrics()
+
+
+# RingBuffer {
+class RingBuffer(object):
+    """
+    Fixed-size history of samples, each a time and a value for every one of the
+    FIELDS. The samples are kept in arrays of doubles allocated up front, once
+    the buffer is full the oldest sample is overwritten by the newest.
+    """
+
+    def __init__(self, size, fields):
+        self.size = size
+        self.fields = tuple(fields)
+        self.times = array.array('d', [0.0]) * size
+        self.values = dict((field, array.array('d', [0.0]) * size) for field in self.fields)
+        # Slot the next sample goes in, and the number of samples held.
+        self.next = 0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return self.count
+
+    def append(self, when, **values):
+        """
+        Adds the sample taken at WHEN. Fields missing from VALUES are stored as 0.
+        """
+        with self.lock:
+            self.times[self.next] = when
+            for field in self.fields:
+                self.values[field][self.next] = values.get(field, 0.0)
+            self.next = (self.next + 1) % self.size
+            self.count = min(self.count + 1, self.size)
+
+    def since(self, start, field):
+        """
+        Returns a list of times and a list of FIELD values of the samples taken at
+        or after START, oldest first.
+        """
+        with self.lock:
+            first = (self.next - self.count) % self.size
+            slots = [(first + i) % self.size for i in range(self.count)]
+            slots = [slot for slot in slots if self.times[slot] >= start]
+            return [self.times[slot] for slot in slots], [self.values[field][slot] for slot in slots]
+
+#} End of RingBuffer
+
+# The state of a device and the time it was read or set. Readers take the whole
+# tuple in one go, writers replace it, so the two always match.
+StateSnapshot = collections.namedtuple('StateSnapshot', ('state', 'time'))
 
 # Wemo {
 class Wemo(object):
@@ -47,22 +601,89 @@ class Wemo(object):
 
     timeout = 2.5
 
-    def __init__(self, url=''):
+    # Times a failed call is retried, and the base of the delay between tries.
+    retries = 2
+    retry_backoff = 0.1
+
+    # Seconds a cached state is used as is, and after which it is no longer used
+    # without asking the device first.
+    state_ttl = 10.0
+    state_max_age = 120.0
+
+    # SSDP search targets for each of the device types.
+    search_targets = { "SOCKET": 'urn:Belkin:device:controllee:1',
+                       "SENSOR": 'urn:Belkin:device:sensor:1',
+                       "LINK"  : 'urn:Belkin:device:bridge:1',
+                       "INSIGHT": 'urn:Belkin:device:insight:1',
+                     }
+
+    # Names of the interfaces searched for devices, every interface that is up
+    # and has an IPv4 address when None.
+    interfaces = None
+
+    # Times an SSDP search is sent, the answers to a lost one come from the next.
+    searches = 2
+
+    # Ports a Wemo's web server may listen on, in the order sweep() tries them,
+    # and how long to wait for each connection.
+    sweep_ports = (49153, 49152, 49154, 49155)
+    sweep_timeout = 0.3
+    sweep_workers = 64
+
+    # SOAP request templates by (service, action), see register_action().
+    soap_templates = {}
+
+    # Keep-alive connections shared by all devices.
+    pool = ConnectionPool()
+
+    # Devices are shared between threads and there can be thousands of them, so
+    # they don't carry a __dict__.
+    __slots__ = ('udn', 'cached_name', 'url', 'ip', 'port', 'health', 'snapshot', 'refreshing',
+                 'lock', 'requests', 'event_callbacks')
+
+    def __init__(self, url='', udn='', name=None, state=None):
         """
-        Initialize the Wemo base class.
+        Initialize the Wemo base class. URL is the device's location and UDN its
+        unique name, as reported in its SSDP response. Nothing is sent to the
+        device here, the NAME and STATE are read from it when first needed unless
+        they are given, for instance from a cache. See prime().
         """
+        self.udn = udn
+        self.cached_name = name
+
+        # Response times, timeouts and failures of this device.
+        self.health = DeviceHealth(Wemo.timeout)
+
+        # Last state read from or set on the device, and when that was.
+        self.snapshot = StateSnapshot('NO_STATE_FOUND', 0)
+
+        # Held while the state is refreshed in the background, so only one
+        # refresh runs at a time.
+        self.refreshing = threading.Lock()
+
+        # Serializes the commands that change the device, and updates of the
+        # snapshot. Reads of the state don't take it.
+        self.lock = threading.RLock()
+
+        # Complete requests for this device, see build_request().
+        self.requests = {}
+
+        # Functions called with the new state whenever the device reports one.
+        self.event_callbacks = []
 
         # Strip off the trailing slash since the commands need to have a leading slash.
-        if url[-1] == '/':
-             self.url = url[:-1]
-        else:
-             self.url = url
+        self.url = url.rstrip('/')
+
+        location = urlparse.urlparse(self.url)
+        if not location.hostname:
+            raise ValueError("Bad device location: %r" % url)
+        self.ip = location.hostname
+        self.port = location.port or 80
 
-        # Strip out the URL information to get the IP address and port.
-        self.ip, self.port = url.strip('http://').strip('/setup.xml').split(':')
-        self.port = int(self.port)
-        self.name = self.get_friendly_name()
-        self.current_state = self.get_current_state()
+        # A given state is kept as already expired, the first read of
+        # current_state checks it with the device.
+        if state is not None:
+            self.snapshot = StateSnapshot(state, 0)
 
     def __str__(self):
         """
@@ -71,105 +692,267 @@ class Wemo(object):
         dev_str = "%s - %s:%s" % ( self.name, self.ip, self.port )
         return dev_str
 
+    def get_name(self):
+        """
+        Returns the friendly name, read from the device the first time. An empty
+        name is returned, and not kept, if the device can't be reached.
+        """
+        name = self.cached_name
+        if name is None:
+            try:
+                name = self.cached_name = self.get_friendly_name()
+            except socket.error:
+                return ''
+        return name
+
+    def set_name(self, name):
+        self.cached_name = name
 
-    def send_to_wemo(self, message):
+    name = property(get_name, set_name)
+
+    def prime(self):
+        """
+        Reads the name and state from the device, unless they are known already.
+        Raises socket.error if the device can't be reached. Returns the device, see
+        Group.prime() to prime many devices at once.
+        """
+        if self.cached_name is None:
+            self.cached_name = self.get_friendly_name()
+        if self.snapshot.time == 0:
+            state = self.get_current_state()
+            if state != 'NO_STATE_FOUND':
+                self.current_state = state
+        return self
+
+
+    def send_to_wemo(self, message, action='other'):
         """
         Sends the SOAP and payload message to the Wemo and returns the data received from
-        the device.
+        the device. Failed calls are retried up to Wemo.retries times after a short,
+        random delay. Raises DeviceDown without trying if the device has been
+        failing, see DeviceHealth. ACTION names the call in the metrics.
         """
-        #
-        # Setup a socket connection to the device.
-        #
-        socket.setdefaulttimeout(Wemo.timeout)
+        labels = (('device', self.cached_name or '%s:%s' % (self.ip, self.port)), ('action', action))
+        if not self.health.allow():
+            metrics.inc('wemo_requests_total', labels + (('result', 'down'),))
+            raise DeviceDown(errno.EHOSTDOWN, 'Device %s:%s is marked down' % (self.ip, self.port))
 
-        # Wemo commands are sent over TCP
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_TCP)
-        # Allow the kernel to reuse the addr without TIME_WAIT expiring
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        attempt = 0
+        while True:
+            start = time.time()
+            try:
+                response = self.exchange(message, self.health.timeout())
+            except socket.error:
+                if attempt >= Wemo.retries or self.health.probing:
+                    self.health.failure()
+                    metrics.inc('wemo_requests_total', labels + (('result', 'error'),))
+                    raise
+                attempt += 1
+                metrics.inc('wemo_retries_total', labels)
+                # Back off with jitter so a fleet of retries doesn't arrive at once.
+                time.sleep(random.uniform(0, Wemo.retry_backoff * 2 ** attempt))
+                continue
+            except Exception:
+                # A reply that can't be parsed is a failure too, and must end a
+                # probe like any other.
+                self.health.failure()
+                metrics.inc('wemo_requests_total', labels + (('result', 'error'),))
+                raise
+            rtt = time.time() - start
+            self.health.success(rtt)
+            metrics.inc('wemo_requests_total', labels + (('result', 'ok'),))
+            metrics.observe('wemo_request_seconds', labels, rtt)
+            return response
+
+    def send_action(self, service, action, **params):
+        """
+        Sends the request for the SERVICE/ACTION pair and returns the response.
+        """
+        return self.send_to_wemo(self.build_request(service, action, **params), action.lower())
+
+    def exchange(self, message, timeout):
+        """
+        Sends MESSAGE over a pooled connection and returns the response. The
+        connection is handed back to the pool when the device allows it to be
+        kept alive.
+        """
+        # A pooled connection may have been dropped by the device since it was
+        # last used. In that case reconnect once and send the message again.
+        while True:
+            sock, reused = Wemo.pool.acquire(self.ip, self.port, timeout)
+            try:
+                sock.sendall(message)
+                response, keep_alive = Wemo.read_response(sock)
+            except socket.timeout:
+                sock.close()
+                raise
+            except socket.error:
+                sock.close()
+                if reused:
+                    continue
+                raise
+            except Exception:
+                # Never leave a half read connection open.
+                sock.close()
+                raise
+
+            if keep_alive:
+                Wemo.pool.release(self.ip, self.port, sock)
+            else:
+                sock.close()
+            return response
 
-        sock.connect((self.ip, self.port))
-        sock.sendto(message, (self.ip, self.port))
-        response = sock.recv(1024)
-        sock.close()
-        return response
+    @staticmethod
+    def recv_more(sock, buf):
+        """
+        Reads whatever SOCK has available onto the end of BUF. Returns False when
+        the device has closed the connection.
+        """
+        chunk = sock.recv(4096)
+        buf.extend(chunk)
+        return bool(chunk)
+
+    @staticmethod
+    def read_response(sock):
+        """
+        Reads one HTTP response off of SOCK, however many packets it arrives in.
+        The body is delimited by Content-Length, chunked encoding or the device
+        closing the connection. Returns the response, with any chunked body
+        decoded, and whether the connection can be used for another request.
+        """
+        buf = bytearray()
+
+        # Read up to the end of the headers.
+        end = -1
+        while end < 0:
+            if not Wemo.recv_more(sock, buf):
+                if not buf:
+                    raise socket.error(errno.ECONNRESET, 'Connection closed by device')
+                return str(buf), False
+            end = buf.find('\r\n\r\n')
+
+        head = str(buf[:end])
+        start = end + 4
+        keep_alive = head.startswith('HTTP/1.1') and not CONNECTION_CLOSE_RE.search(head)
+        status = head.split(' ', 2)[1] if ' ' in head else ''
+        length = CONTENT_LENGTH_RE.search(head)
+
+        if status in ('204', '304') or status.startswith('1'):
+            body = ''
+
+        elif CHUNKED_RE.search(head):
+            body = bytearray()
+            pos = start
+            while True:
+                # Each chunk starts with its size in hex on a line of its own.
+                line_end = buf.find('\r\n', pos)
+                while line_end < 0:
+                    if not Wemo.recv_more(sock, buf):
+                        return head + '\r\n\r\n' + str(body), False
+                    line_end = buf.find('\r\n', pos)
+                size = int(str(buf[pos:line_end]).split(';')[0].strip() or '0', 16)
+                pos = line_end + 2
+
+                if size == 0:
+                    # Skip any trailers up to the closing blank line.
+                    while True:
+                        line_end = buf.find('\r\n', pos)
+                        while line_end < 0:
+                            if not Wemo.recv_more(sock, buf):
+                                return head + '\r\n\r\n' + str(body), False
+                            line_end = buf.find('\r\n', pos)
+                        if line_end == pos:
+                            break
+                        pos = line_end + 2
+                    break
+
+                while len(buf) < pos + size + 2:
+                    if not Wemo.recv_more(sock, buf):
+                        body.extend(buf[pos:pos + size])
+                        return head + '\r\n\r\n' + str(body), False
+                body.extend(buf[pos:pos + size])
+                pos += size + 2
+            body = str(body)
+
+        elif length:
+            length = int(length.group(1))
+            while len(buf) < start + length:
+                if not Wemo.recv_more(sock, buf):
+                    keep_alive = False
+                    break
+            body = str(buf[start:start + length])
+
+        else:
+            # Without a length the only end of the body is the device closing
+            # the connection.
+            keep_alive = False
+            while Wemo.recv_more(sock, buf):
+                pass
+            body = str(buf[start:])
+
+        return head + '\r\n\r\n' + body, keep_alive
+
+    # register_action(){
+    @staticmethod
+    def register_action(service, action, path, urn, soap_action, args=''):
+        """
+        Adds the SOAP request for the SERVICE/ACTION pair to the template registry.
+        PATH is the control URL, URN the service type and SOAP_ACTION the name of
+        the action on the device. ARGS is the XML placed inside the action element.
+        It may contain %(name)s fields, which are filled in from the parameters
+        passed to build_request().
+        """
+        header = 'POST %s HTTP/1.1\r\n' % path +\
+                 'SOAPAction: "%s#%s"\r\n' % (urn, soap_action)
+        payload = '<?xml version="1.0"?>\n' +\
+                  '<SOAP-ENV:Envelope xmlns:SOAP-ENV="http://schemas.xmlsoap.org/soap/envelope/" SOAP-ENV:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/">\n' +\
+                  '<SOAP-ENV:Body>\n' +\
+                  '\t<m:%s xmlns:m="%s">\n' % (soap_action, urn) +\
+                  args + '\n' +\
+                  '\t</m:%s>\n' % soap_action +\
+                  '</SOAP-ENV:Body>\n' +\
+                  '</SOAP-ENV:Envelope>'
+        Wemo.soap_templates[(service.upper(), action.upper())] = (header, payload)
+    #} End of register_action()
+
+    # build_request(){
+    def build_request(self, service, action, **params):
+        """
+        Returns the complete HTTP request for the SERVICE/ACTION pair. Requests
+        without PARAMS are built once per device and then served from a cache.
+        """
+        key = (service.upper(), action.upper())
+        if not params:
+            request = self.requests.get(key)
+            if request is None:
+                request = self.format_request(key, params)
+                self.requests[key] = request
+            return request
+        return self.format_request(key, params)
+    #} End of build_request()
+
+    def format_request(self, key, params):
+        """
+        Fills in the template stored under KEY for this device.
+        """
+        header, payload = Wemo.soap_templates[key]
+        if params:
+            payload = payload % params
+        if isinstance(payload, unicode):
+            payload = payload.encode('utf-8')
+        return header +\
+               'Host: %s:%s\r\n' % (self.ip, self.port) +\
+               'Content-Type: text/xml\r\n' +\
+               'Content-Length: %d\r\n\r\n' % len(payload) +\
+               payload
 
     # get_soap_payload(){
     def get_soap_payload(self, service, action):
         """
         Returns a SOAP header and payload to send to a Wemo.
         """
-
-        # TODO: Move the XML data to template files.
-        SOAP = ''
-        payload = ''
-        host = ''
-        host = "Host: %s:%s\r\n" % (self.ip, self.port)
-        ####################
-        # Services         #
-        ####################
-
-        if service.upper() == 'SET_BIN_STATE':
-            SOAP = 'POST /upnp/control/basicevent1 HTTP/1.1\r\n' +\
-                         'SOAPAction: "urn:Belkin:service:basicevent:1#SetBinaryState"\r\n' +\
-                         host +\
-                         'Content-Type: text/xml\r\n' +\
-                         'Content-Length: 333\r\n\r\n'
-
-        if service.upper() == 'GET_BIN_STATE':
-            SOAP = 'POST /upnp/control/basicevent1 HTTP/1.1\r\n' +\
-                         'SOAPAction: "urn:Belkin:service:basicevent:1#GetBinaryState"\r\n' +\
-                         host +\
-                         'Content-Type: text/xml\r\n' +\
-                         'Content-Length: 305\r\n\r\n'
-
-        if service.upper() == 'GET_FRIEND_NAME':
-            SOAP = 'POST /upnp/control/basicevent1 HTTP/1.1\r\n' +\
-                         'SOAPAction: "urn:Belkin:service:basicevent:1#GetFriendlyName"\r\n' +\
-                         host +\
-                         'Content-Type: text/xml\r\n' +\
-                         'Content-Length: 336\r\n\r\n'
-
-        ####################
-        # Actions          #
-        ####################
-        if action.upper() == 'TURN_ON':
-            payload = '<?xml version="1.0"?>\n' +\
-                                '<SOAP-ENV:Envelope xmlns:SOAP-ENV="http://schemas.xmlsoap.org/soap/envelope/" SOAP-ENV:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/">\n' +\
-                                '<SOAP-ENV:Body>\n' +\
-                                '\t<m:SetBinaryState xmlns:m="urn:Belkin:service:basicevent:1">\n' +\
-                                '<BinaryState>1</BinaryState>\n' +\
-                                '\t</m:SetBinaryState>\n' +\
-                                '</SOAP-ENV:Body>\n' +\
-                                '</SOAP-ENV:Envelope>'
-        if action.upper() == 'TURN_OFF':
-            payload = '<?xml version="1.0"?>\n' +\
-                                '<SOAP-ENV:Envelope xmlns:SOAP-ENV="http://schemas.xmlsoap.org/soap/envelope/" SOAP-ENV:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/">\n' +\
-                                '<SOAP-ENV:Body>\n' +\
-                                '\t<m:SetBinaryState xmlns:m="urn:Belkin:service:basicevent:1">\n' +\
-                                '<BinaryState>0</BinaryState>\n' +\
-                                '\t</m:SetBinaryState>\n' +\
-                                '</SOAP-ENV:Body>\n' +\
-                                '</SOAP-ENV:Envelope>'
-        if action.upper() == 'GET_NAME':
-            payload = '<?xml version="1.0"?>\n' +\
-                                '<SOAP-ENV:Envelope xmlns:SOAP-ENV="http://schemas.xmlsoap.org/soap/envelope/" SOAP-ENV:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/">\n' +\
-                                '<SOAP-ENV:Body>\n' +\
-                                '\t<m:GetFriendlyName xmlns:m="urn:Belkin:service:basicevent:1">\n' +\
-                                '<FriendlyName></FriendlyName>\n' +\
-                                '\t</m:GetFriendlyName>\n' +\
-                                '</SOAP-ENV:Body>\n' +\
-                                '</SOAP-ENV:Envelope>'
-
-        if action.upper() == 'GET_STATE':
-            payload = '<?xml version="1.0"?>\n' +\
-                                '<SOAP-ENV:Envelope xmlns:SOAP-ENV="http://schemas.xmlsoap.org/soap/envelope/" SOAP-ENV:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/">\n' +\
-                                '<SOAP-ENV:Body>\n' +\
-                                '\t<m:GetBinaryState xmlns:m="urn:Belkin:service:basicevent:1">\n\n' +\
-                                '\t</m:GetBinaryState>\n' +\
-                                '</SOAP-ENV:Body>\n' +\
-                                '</SOAP-ENV:Envelope>'
-
-        return SOAP, payload
+        header, payload = self.build_request(service, action).split('\r\n\r\n', 1)
+        return header + '\r\n\r\n', payload
     #} End of get_soap_payload()
 
     # get_friendly_name(){
@@ -178,38 +961,15 @@ class Wemo(object):
         Returns the "friendly name" of the Wemo.
         """
         #
-        # In some cases, the response from the WeMo will come back in two TCP packets
-        # send_to_wemo() only reads the first packet off the wire, which would cause
-        # NO_NAME_FOUND, even when the second packet had the data. Now this function
-        # will handle all aspects of getting the name, including setting up the TCP
-        # connection.
-        #
-        name = ''
-        tries = 0
-        MAX_TRIES = 5
-        soap_header, payload_data = self.get_soap_payload('GET_FRIEND_NAME', 'GET_NAME')
-        message = soap_header + payload_data
+        # In some cases, the response from the WeMo will come back in two TCP packets.
+        # send_to_wemo() reads the whole response off the wire, so the name is
+        # found even when it arrives in the second packet.
         #
-        # Setup a socket connection to the device.
-        #
-        socket.setdefaulttimeout(Wemo.timeout)
+        response = self.send_action('GET_FRIEND_NAME', 'GET_NAME')
 
-        # Wemo commands are sent over TCP
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_TCP)
-        # Allow the kernel to reuse the addr without TIME_WAIT expiring
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-
-        sock.connect((self.ip, self.port ))
-        sock.sendto( message, (self.ip, self.port ) )
-        response = sock.recv(1024)
-        while not name and tries < MAX_TRIES:
-            name = re.search('<FriendlyName>(.*)</FriendlyName>', response, re.IGNORECASE)
-            if name:
-                    return name.group(1)
-            else:
-                 response = sock.recv(1024)
-                 tries += 1
-        sock.close()
+        name = FRIENDLY_NAME_RE.search(response)
+        if name:
+            return name.group(1)
         return 'NO_NAME_FOUND'
     #} End of get_friendly_name()
 
@@ -218,47 +978,106 @@ class Wemo(object):
         """
         Returns the current state of the Wemo device.
         """
-        #
-        # In some cases, the response from the WeMo will come back in two TCP packets
-        # send_to_wemo() only reads the first packet off the wire, which would cause
-        # NO_NAME_FOUND, even when the second packet had the data. Now this function
-        # will handle all aspects of getting the name, including setting up the TCP
-        # connection.
-        #
-        name = ''
-        tries = 0
-        MAX_TRIES = 5
-        soap_header, payload_data = self.get_soap_payload('GET_BIN_STATE', 'GET_STATE')
-        message = soap_header + payload_data
-        #
-        # Setup a socket connection to the device.
-        #
-        # TODO: Setup a socket factory to return configured sockets
-        socket.setdefaulttimeout(Wemo.timeout)
-
-        # Wemo commands are sent over TCP
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_TCP)
-        # Allow the kernel to reuse the addr without TIME_WAIT expiring
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        response = self.send_action('GET_BIN_STATE', 'GET_STATE')
 
-        sock.connect((self.ip, self.port ))
-        sock.sendto( message, (self.ip, self.port ) )
-        response = sock.recv(1024)
-
-        while not name and tries < MAX_TRIES:
-            name = re.search('<BinaryState>(.*)</BinaryState>', response, re.IGNORECASE)
-            if name:
-                if '1' in name.group(1):
-                    return 'ON'
-                if '0' in name.group(1):
-                    return 'OFF'
-            else:
-                 response = sock.recv(1024)
-                 tries += 1
-        sock.close()
+        state = BINARY_STATE_RE.search(response)
+        if state:
+            return Wemo.parse_state(state.group(1))
         return 'NO_STATE_FOUND'
     #} End of get_current_state()
 
+    def get_state(self):
+        """
+        Returns the cached state of the device. A state older than state_ttl is
+        refreshed in the background while the cached value is returned, one older
+        than state_max_age is read from the device before returning.
+        """
+        snapshot = self.snapshot
+        age = time.time() - snapshot.time
+        if age > self.state_max_age:
+            return self.refresh_state()
+        if age > self.state_ttl and self.refreshing.acquire(False):
+            thread = threading.Thread(target=self.background_refresh)
+            thread.daemon = True
+            thread.start()
+        return snapshot.state
+
+    def set_state(self, state):
+        """
+        Records STATE as the device's state as of now.
+        """
+        with self.lock:
+            self.snapshot = StateSnapshot(state, time.time())
+
+    # Reads and writes of current_state go through the cache.
+    current_state = property(get_state, set_state)
+
+    # The state and the time of the snapshot, for callers that don't need both.
+    cached_state = property(lambda self: self.snapshot.state)
+    state_time = property(lambda self: self.snapshot.time)
+
+    def refresh_state(self):
+        """
+        Reads the state from the device into the cache and returns it. The cached
+        state is returned if the device can't be reached.
+        """
+        started = time.time()
+        try:
+            state = self.get_current_state()
+            with self.lock:
+                # Don't let a slow read overwrite a state set while it was running.
+                if state != 'NO_STATE_FOUND' and self.snapshot.time <= started:
+                    self.snapshot = StateSnapshot(state, time.time())
+        except socket.error:
+            pass
+        return self.snapshot.state
+
+    def background_refresh(self):
+        """
+        Runs refresh_state() for get_state(), which took the refreshing lock.
+        """
+        try:
+            self.refresh_state()
+        finally:
+            self.refreshing.release()
+
+    def invalidate_state(self):
+        """
+        Forgets the cached state, the next read will ask the device.
+        """
+        with self.lock:
+            self.snapshot = StateSnapshot(self.snapshot.state, 0)
+
+    @staticmethod
+    def parse_state(value):
+        """
+        Translates a BinaryState value into 'ON' or 'OFF'. An Insight reports more
+        fields after a '|', and 8 when it is on with no load.
+        """
+        value = value.split('|')[0]
+        if '8' in value:
+            return 'ON'
+        if '1' in value:
+            return 'ON'
+        if '0' in value:
+            return 'OFF'
+        return 'NO_STATE_FOUND'
+
+    def add_event_callback(self, func):
+        """
+        Registers FUNC to be called with the device and its new state whenever the
+        device reports a state change.
+        """
+        self.event_callbacks.append(func)
+
+    def handle_event(self, state):
+        """
+        Called by the EventListener when the device reports a new STATE.
+        """
+        self.current_state = state
+        for func in self.event_callbacks:
+            func(self, state)
+
 
     @staticmethod
     def get_active_iface_addr():
@@ -277,7 +1096,55 @@ class Wemo(object):
     @staticmethod
     def find_wemos(dev_type):
         """
-        Find the WeMo devices on the network.
+        Find the WeMo devices of type DEV_TYPE on the network.
+        """
+        if dev_type.upper() not in Wemo.search_targets:
+            return []
+        return Wemo.find_all_wemos([dev_type])[dev_type.upper()]
+    #} End of find_wemos()
+
+    # find_all_wemos(){
+    @staticmethod
+    def find_all_wemos(dev_types=None, deadline=None, mx=2, expected=None, callback=None,
+                       address=None, ranges=None):
+        """
+        Find the WeMo devices of every type in DEV_TYPES (all known types by
+        default) with a single SSDP search. Returns a dict mapping each type to the
+        list of device locations that responded. See discover() for the rest of the
+        arguments.
+        """
+        if dev_types is None:
+            dev_types = Wemo.search_targets.keys()
+        wemos = dict((dev_type.upper(), []) for dev_type in dev_types
+                                            if dev_type.upper() in Wemo.search_targets)
+
+        start = time.time()
+        for dev_type, location, udn in Wemo.discover(wemos.keys(), deadline, mx, expected, address,
+                                                     ranges):
+            wemos[dev_type].append(location)
+            metrics.inc('wemo_discovered_total', (('type', dev_type),))
+            if callback:
+                callback(dev_type, location, udn)
+        metrics.observe('wemo_discovery_seconds', (), time.time() - start)
+        return wemos
+    #} End of find_all_wemos()
+
+    # discover(){
+    @staticmethod
+    def discover(dev_types=None, deadline=None, mx=2, expected=None, address=None, ranges=None):
+        """
+        Generator that searches for WeMo devices of every type in DEV_TYPES and
+        yields a (dev_type, location, udn) tuple for each new device as soon as its
+        response arrives. The search ends DEADLINE seconds after it started
+        (Wemo.timeout by default), or as soon as EXPECTED devices have been found.
+        MX is the longest time, in seconds, a device may wait before responding.
+
+        The search is multicast on every interface from detect_ifaces() at once,
+        and sent Wemo.searches times since a single datagram is easily lost.
+        ADDRESS, an (ip, port) tuple, sends the search to that host only instead of
+        the multicast group, such as a simulator from wemo_sim.py. RANGES, a list
+        of CIDR blocks, are swept with sweep() at the same time, for networks
+        where multicast doesn't get through.
         """
         #
         # Set the Multicast address and port for SSDP
@@ -285,77 +1152,241 @@ class Wemo(object):
         MULTICAST_ADDR = '239.255.255.250'
         MULTICAST_PORT = 1900
 
-        devices = { "SOCKET": 'ST:urn:Belkin:device:controllee:1\r\n',
-                    "SENSOR": 'ST:urn:Belkin:device:sensor:1\r\n',
-                    "LINK"  : 'ST:urn:Belkin:device:bridge:1\r\n',
-                  }
-        if dev_type.upper() in devices:
-           service_type = devices[dev_type.upper()]
+        if dev_types is None:
+            dev_types = Wemo.search_targets.keys()
+        dev_types = [dev_type.upper() for dev_type in dev_types
+                                      if dev_type.upper() in Wemo.search_targets]
+        targets = dict((Wemo.search_targets[dev_type].lower(), dev_type) for dev_type in dev_types)
+        if not dev_types:
+            return
+        if deadline is None:
+            deadline = Wemo.timeout
+        start = time.time()
+        end_time = start + deadline
+
+        # Multicast from every interface, a unicast search only needs one socket.
+        if address is None:
+            address = (MULTICAST_ADDR, MULTICAST_PORT)
+            local_addrs = [addr for name, addr in Wemo.detect_ifaces()] or \
+                          [Wemo.get_active_iface_addr()]
         else:
-            return []
-
-        # MX (maximum wait time for response in seconds = 2)
-        DISCOVER =    'M-SEARCH * HTTP/1.1\r\n' +\
-                                'HOST:%s:%s\r\n' % (MULTICAST_ADDR, MULTICAST_PORT) +\
-                                service_type    +\
-                                'MX:2\r\n'                                +\
-                                'MAN:"ssdp:discover"\r\n\r\n'
-
-        # Set socket timer to TIMEOUT seconds, any blocking operation on sockets will
-        # abort if TIMEOUT seconds elapse.
-        socket.setdefaulttimeout(Wemo.timeout)
-
-        loc_addr = Wemo.get_active_iface_addr()
-
-        #
-        # Setup and send the MULTICAST request
-        #
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP) # Internet socket using UDP
-
-        # Manually change the multicast interface to the chosen one.
-        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(loc_addr))
-
-        # Allow the kernel to reuse the socket even if TIME_WAIT has not expired.
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-
-        # Bind the socket to the chosen address and open the multicast port.
-        sock.bind((loc_addr, MULTICAST_PORT))
-
-        # Ask politely to join the multicast group.
-        multicast_request = struct.pack('4sl', socket.inet_aton(MULTICAST_ADDR), socket.INADDR_ANY)
-        sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, multicast_request)
-
-        # Send the DISCOVER string to look for Wemos on the network.
-        sock.sendto(DISCOVER, (MULTICAST_ADDR, MULTICAST_PORT))
-
-        raw_wemos = []
-        wemos = []
-        found = 0
-
-        while True:
+            local_addrs = [None]
+
+        # One DISCOVER string per device type to look for Wemos on the network.
+        searches = ['M-SEARCH * HTTP/1.1\r\n' +\
+                    'HOST:%s:%s\r\n' % address +\
+                    'ST:%s\r\n' % Wemo.search_targets[dev_type] +\
+                    'MX:%d\r\n' % mx +\
+                    'MAN:"ssdp:discover"\r\n\r\n' for dev_type in dev_types]
+
+        # Devices found by the sweep, if there is one.
+        swept = collections.deque()
+        stop = threading.Event()
+        sweeper = None
+
+        socks = []
+        try:
+            for loc_addr in local_addrs:
+                sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP) # Internet socket using UDP
+                socks.append(sock)
+
+                # A big fleet answers all at once, make room for the burst.
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+                if loc_addr is None:
+                    continue
+
+                # Send the search out of this interface. The answers are unicast
+                # back to the sending port, so any free port will do.
+                sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(loc_addr))
+                sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 2)
+                sock.bind((loc_addr, 0))
+
+            if ranges:
+                sweeper = threading.Thread(target=Wemo.sweep,
+                                           args=(ranges, dev_types, deadline,
+                                                 lambda *found: swept.append(found), stop))
+                sweeper.daemon = True
+                sweeper.start()
+
+            # Locations that have already been reported.
+            seen = set()
+
+            # The search is repeated in the first half of the deadline, so there is
+            # time left for the answers to a late one.
+            interval = deadline / 2.0 / max(1, Wemo.searches)
+            sent = 0
+            next_search = start
+
+            while True:
+                now = time.time()
+                if now >= end_time:
+                    break
+
+                if sent < Wemo.searches and now >= next_search:
+                    for sock in socks:
+                        for search in searches:
+                            try:
+                                sock.sendto(search, address)
+                            except socket.error:
+                                pass
+                    sent += 1
+                    next_search = now + interval
+
+                # Wait for a response, but no longer than the deadline or the next
+                # search allow. Check on the sweep every so often.
+                timeout = end_time - now
+                if sent < Wemo.searches:
+                    timeout = min(timeout, next_search - now)
+                if sweeper and sweeper.is_alive():
+                    timeout = min(timeout, 0.05)
+                try:
+                    readable = select.select(socks, [], [], max(0, timeout))[0]
+                except select.error as err:
+                    if err.args[0] != errno.EINTR:
+                        raise
+                    readable = []
+
+                found = []
+                for sock in readable:
+                    try:
+                        wemo = sock.recv(1024)
+                    except socket.error:
+                        continue
+
+                    # Search through the device information looking for key data.
+                    url_found = LOCATION_RE.search(wemo)
+                    st_found = ST_RE.search(wemo)
+                    if not url_found or not st_found:
+                        continue
+
+                    dev_type = targets.get(st_found.group(1).strip().lower())
+                    usn_found = USN_RE.search(wemo)
+                    if dev_type:
+                        found.append((dev_type, url_found.group(1).strip(),
+                                      usn_found.group(1).strip() if usn_found else ''))
+
+                while swept:
+                    found.append(swept.popleft())
+
+                for dev_type, location, udn in found:
+                    if location in seen:
+                        continue
+                    seen.add(location)
+                    yield dev_type, location, udn
+
+                    if expected and len(seen) >= expected:
+                        return
+        finally:
+            stop.set()
+            for sock in socks:
+                sock.close()
+    #} End of discover()
+
+    # sweep(){
+    @staticmethod
+    def sweep(ranges, dev_types=None, deadline=None, callback=None, stop=None):
+        """
+        Looks for WeMo devices of every type in DEV_TYPES at each address in RANGES
+        by asking for their /setup.xml, see probe_setup(). Returns a list of
+        (dev_type, location, udn) tuples, and calls CALLBACK with each one as it is
+        found. Addresses that haven't been probed after DEADLINE seconds, or once
+        the STOP event is set, are skipped.
+        """
+        if dev_types is None:
+            dev_types = Wemo.search_targets.keys()
+        dev_types = set(dev_type.upper() for dev_type in dev_types)
+        end_time = time.time() + (Wemo.timeout if deadline is None else deadline)
+        start = time.time()
+        found = []
+
+        def probe(ip):
+            if time.time() >= end_time or (stop and stop.is_set()):
+                return
+            result = Wemo.probe_setup(ip)
+            if result and result[0] in dev_types:
+                found.append(result)
+                if callback:
+                    callback(*result)
+
+        run_concurrently(probe, expand_ranges(ranges), Wemo.sweep_workers)
+        metrics.observe('wemo_sweep_seconds', (), time.time() - start)
+        return found
+    #} End of sweep()
+
+    # probe_setup(){
+    @staticmethod
+    def probe_setup(ip):
+        """
+        Asks for /setup.xml on each of Wemo.sweep_ports at IP. Returns a
+        (dev_type, location, udn) tuple for the first WeMo that answers, or None.
+        """
+        targets = dict((target.lower(), dev_type) for dev_type, target in Wemo.search_targets.items())
+        for port in Wemo.sweep_ports:
             try:
-                # Try to receive data from any Wemo devices on the network.
-                raw_wemos.append(sock.recv(1024))
+                sock = socket.create_connection((ip, port), Wemo.sweep_timeout)
             except socket.timeout:
-                # When no more Wemos respond within TIMEOUT seconds, then the socket will administratively
-                # kill the connection with a timeout exception.
-                break
-            found += 1
+                # Nothing at this address, don't wait for the other ports.
+                return None
+            except socket.error:
+                continue
 
-        for wemo in raw_wemos:
-            # Search through the device information looking for key data.
-            url_found = re.search(r'location:\s*(.*)', wemo, re.IGNORECASE)
+            location = 'http://%s:%d/setup.xml' % (ip, port)
+            try:
+                sock.settimeout(Wemo.timeout)
+                sock.sendall('GET /setup.xml HTTP/1.1\r\n' +\
+                             'HOST: %s:%d\r\n' % (ip, port) +\
+                             'Connection: close\r\n\r\n')
+                response, _ = Wemo.read_response(sock)
+            except (socket.error, ValueError):
+                continue
+            finally:
+                sock.close()
+
+            dev_type = DEVICE_TYPE_RE.search(response)
+            udn = UDN_RE.search(response)
+            if dev_type and dev_type.group(1).strip().lower() in targets:
+                return (targets[dev_type.group(1).strip().lower()], location,
+                        udn.group(1).strip() if udn else '')
+        return None
+    #} End of probe_setup()
 
-            if url_found:
-                wemo_data = url_found.group(1).strip('\r\n')
 
-                if wemo_data not in wemos:
-                    wemos.append(wemo_data)
 
-        if wemos:
-            return wemos
-        return []
-    #} End of find_wemos()
+    @staticmethod
+    def detect_ifaces():
+        """
+        Returns a (name, address) tuple for each interface that is up, can
+        multicast and has an IPv4 address, leaving out the loopback. Only the
+        interfaces named in Wemo.interfaces are returned if it is set.
+        """
+        SIOCGIFFLAGS = 0x8913
+        SIOCGIFADDR = 0x8915
+        IFF_UP = 0x1
+        IFF_LOOPBACK = 0x8
+        IFF_MULTICAST = 0x1000
+
+        with open('/proc/net/dev', 'r') as net_file:
+            # The first two lines are the table header.
+            names = [line.split(':', 1)[0].strip() for line in net_file.readlines()[2:]]
+
+        ifaces = []
+        null_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            for name in names:
+                if Wemo.interfaces is not None and name not in Wemo.interfaces:
+                    continue
+                request = struct.pack('256s', name[:15])
+                try:
+                    flags = struct.unpack('H', fcntl.ioctl(null_socket.fileno(), SIOCGIFFLAGS, request)[16:18])[0]
+                    addr = socket.inet_ntoa(fcntl.ioctl(null_socket.fileno(), SIOCGIFADDR, request)[20:24])
+                except IOError:
+                    # No IPv4 address on this one.
+                    continue
+                if flags & IFF_UP and flags & IFF_MULTICAST and not flags & IFF_LOOPBACK:
+                    ifaces.append((name, addr))
+        finally:
+            null_socket.close()
+        return ifaces
 
 
     @staticmethod
@@ -381,6 +1412,34 @@ class Wemo(object):
 
 #} End of Wemo Class
 
+# Actions of the basicevent1 service.
+Wemo.register_action('SET_BIN_STATE', 'TURN_ON', '/upnp/control/basicevent1',
+                     'urn:Belkin:service:basicevent:1', 'SetBinaryState',
+                     '<BinaryState>1</BinaryState>')
+Wemo.register_action('SET_BIN_STATE', 'TURN_OFF', '/upnp/control/basicevent1',
+                     'urn:Belkin:service:basicevent:1', 'SetBinaryState',
+                     '<BinaryState>0</BinaryState>')
+Wemo.register_action('GET_BIN_STATE', 'GET_STATE', '/upnp/control/basicevent1',
+                     'urn:Belkin:service:basicevent:1', 'GetBinaryState')
+Wemo.register_action('GET_FRIEND_NAME', 'GET_NAME', '/upnp/control/basicevent1',
+                     'urn:Belkin:service:basicevent:1', 'GetFriendlyName',
+                     '<FriendlyName></FriendlyName>')
+
+# Actions of the insight1 service of an Insight.
+Wemo.register_action('INSIGHT', 'GET_PARAMS', '/upnp/control/insight1',
+                     'urn:Belkin:service:insight:1', 'GetInsightParams')
+
+# Actions of the bridge1 service of a Link.
+Wemo.register_action('BRIDGE', 'GET_END_DEVICES', '/upnp/control/bridge1',
+                     'urn:Belkin:service:bridge:1', 'GetEndDevices',
+                     '<DevUDN>%(udn)s</DevUDN><ReqListType>PAIRED_LIST</ReqListType>')
+Wemo.register_action('BRIDGE', 'GET_DEVICE_STATUS', '/upnp/control/bridge1',
+                     'urn:Belkin:service:bridge:1', 'GetDeviceStatus',
+                     '<DeviceIDs>%(ids)s</DeviceIDs>')
+Wemo.register_action('BRIDGE', 'SET_DEVICE_STATUS', '/upnp/control/bridge1',
+                     'urn:Belkin:service:bridge:1', 'SetDeviceStatus',
+                     '<DeviceStatusList>%(status_list)s</DeviceStatusList>')
+
 
 
 # Wemo Socket class {
@@ -389,31 +1448,47 @@ class Socket(Wemo):
     Socket class represents Wemo smart socket devices.
     """
 
+    __slots__ = ()
+
     def turn_on(self):
         """
-        Sets the current_state and sends the command to turn the socket ON.
+        Sends the command to turn the socket ON and sets the current_state once
+        the device has taken it.
         """
-        self.current_state = 'ON'
-        soap_header, payload_data = self.get_soap_payload('SET_BIN_STATE','TURN_ON')
-        self.send_to_wemo(soap_header + payload_data )
+        with self.lock:
+            try:
+                self.send_action('SET_BIN_STATE', 'TURN_ON')
+            except Exception:
+                # The device may or may not have switched.
+                self.invalidate_state()
+                raise
+            self.current_state = 'ON'
 
 
     def turn_off(self):
         """
-        Sets the current_state and sends the command to turn the socket OFF.
+        Sends the command to turn the socket OFF and sets the current_state once
+        the device has taken it.
         """
-        self.current_state = 'OFF'
-        soap_header, payload_data = self.get_soap_payload('SET_BIN_STATE','TURN_OFF')
-        self.send_to_wemo(soap_header + payload_data )
+        with self.lock:
+            try:
+                self.send_action('SET_BIN_STATE', 'TURN_OFF')
+            except Exception:
+                # The device may or may not have switched.
+                self.invalidate_state()
+                raise
+            self.current_state = 'OFF'
 
     def toggle(self):
         """
-        Checks the current_state and either sends an ON or OFF command.
+        Checks the current_state and either sends an ON or OFF command. No other
+        command gets in between the two.
         """
-        if 'ON' in self.current_state:
-            self.turn_off()
-        elif 'OFF' in self.current_state:
-            self.turn_on()
+        with self.lock:
+            if 'ON' in self.current_state:
+                self.turn_off()
+            elif 'OFF' in self.current_state:
+                self.turn_on()
 
     @staticmethod
     def find_wemos():
@@ -426,13 +1501,110 @@ class Socket(Wemo):
 
 
 
+# Wemo Insight class {
+class Insight(Socket):
+    """
+    Insight class represents Wemo Insight sockets, which also measure the power
+    drawn through them. Samples taken with sample() are kept in a RingBuffer of
+    Insight.history_size entries per device.
+    """
+
+    history_size = 4096
+
+    __slots__ = ('history',)
+
+    # Names of the fields of the InsightParams value, in order. Power is in mW,
+    # energy in mW minutes and times in seconds.
+    params = ('state', 'last_change', 'on_for', 'on_today', 'on_total', 'time_period',
+              'average_power', 'current_power', 'today_energy', 'total_energy', 'threshold')
+
+    def __init__(self, url='', udn='', name=None, state=None):
+        self.history = RingBuffer(Insight.history_size, ('power', 'state'))
+        super(Insight, self).__init__(url, udn, name, state)
+
+    def get_insight_params(self):
+        """
+        Returns a dict of the device's InsightParams, see Insight.params. Current
+        power is also given in watts and the energy used in kWh.
+        """
+        response = self.send_action('INSIGHT', 'GET_PARAMS')
+        fields = xml_field(INSIGHT_PARAMS_RE, response).split('|')
+        if len(fields) < 8:
+            raise ValueError("Unexpected InsightParams from %s:%s" % (self.ip, self.port))
+
+        params = dict((name, float(value) if value.strip() else 0.0)
+                      for name, value in zip(Insight.params, fields))
+        params['power_w'] = params['current_power'] / 1000.0
+        params['today_kwh'] = params.get('today_energy', 0.0) / 6e7
+        params['total_kwh'] = params.get('total_energy', 0.0) / 6e7
+        return params
+
+    def sample(self):
+        """
+        Reads the power drawn now and adds it to the history. Returns a dict with
+        the time, power in watts and state.
+        """
+        params = self.get_insight_params()
+        now = time.time()
+        state = Wemo.parse_state('%d' % params['state'])
+        self.history.append(now, power=params['power_w'], state=params['state'])
+        self.current_state = state
+        metrics.set('wemo_insight_power_watts', (('device', self.name),), params['power_w'])
+        return { "time": now, "power_w": params['power_w'], "state": state,
+                 "today_kwh": params['today_kwh'] }
+
+    def window(self, seconds):
+        """
+        Aggregates the samples of the last SECONDS. Returns a dict with the number
+        of samples, the mean and maximum power in watts and the energy used in kWh,
+        counting each sample's power until the next one was taken.
+        """
+        times, power = self.history.since(time.time() - seconds, 'power')
+        if not times:
+            return { "samples": 0 }
+        joules = sum(power[i] * (times[i + 1] - times[i]) for i in range(len(times) - 1))
+        return { "samples": len(times),
+                 "mean_w": sum(power) / len(power),
+                 "max_w": max(power),
+                 "kwh": joules / 3.6e6 }
+
+    @staticmethod
+    def find_wemos():
+        """
+        Extends the base version to look specifically for Insights.
+        """
+        return Wemo.find_wemos("INSIGHT")
+
+#} End of Wemo Insight class
+
+
 # Wemo Sensor class {
 class Sensor(Wemo):
     """
     Sensor class represents Wemo motion sensor devices.
     """
+
+    __slots__ = ('last_motion',)
+
+    def __init__(self, url='', udn='', name=None, state=None):
+        # Time the sensor last reported motion.
+        self.last_motion = 0
+        super(Sensor, self).__init__(url, udn, name, state)
+
+    def handle_event(self, state):
+        """
+        Extends the base version to remember when motion was last seen.
+        """
+        if state == 'ON':
+            self.last_motion = time.time()
+        super(Sensor, self).handle_event(state)
+
     def check_for_motion(self):
-        print "I'm checking for motion!"
+        """
+        Returns True if the sensor's last report was that it sees motion. The
+        reports are pushed by an EventListener the sensor is subscribed to.
+        """
+        return self.current_state == 'ON'
 
     @staticmethod
     def find_wemos():
@@ -446,8 +1618,159 @@ class Sensor(Wemo):
 
 # Wemo Link class {
 class Link(Wemo):
+    """
+    Link class represents the WeMo Link, a bridge that fronts a number of bulbs.
+    The bulbs are controlled through the bridge, any number of them with a single
+    request.
+    """
+
+    __slots__ = ('bulbs',)
 
-    # TODO: Merge in WemoPOC's Link class methods. (After socket factory)
+    def __init__(self, url='', udn='', name=None, state=None):
+        # Bulb ID -> Bulb, see get_end_devices().
+        self.bulbs = collections.OrderedDict()
+        super(Link, self).__init__(url, udn, name, state)
+
+    def get_end_devices(self):
+        """
+        Reads the list of bulbs paired with the bridge, along with their state.
+        Returns the list of Bulb objects.
+        """
+        response = self.send_action('BRIDGE', 'GET_END_DEVICES', udn=self.udn)
+
+        bulbs = collections.OrderedDict()
+        for info in DEVICE_INFO_RE.findall(saxutils.unescape(xml_field(DEVICE_LISTS_RE, response))):
+            dev_id = xml_field(DEVICE_ID_RE, info)
+            if not dev_id:
+                continue
+            bulb = self.bulbs.get(dev_id) or Bulb(self, dev_id)
+            bulb.name = xml_field(FRIENDLY_NAME_RE, info) or dev_id
+            bulb.update(xml_field(CAPABILITY_ID_RE, info), xml_field(CURRENT_STATE_RE, info))
+            bulbs[dev_id] = bulb
+        self.bulbs = bulbs
+        return bulbs.values()
+
+    def get_bulbs(self, bulbs=None):
+        """
+        Returns the Bulb objects BULBS refers to, a list of bulbs, IDs or friendly
+        names. Every bulb is returned if BULBS is None.
+        """
+        if not self.bulbs:
+            self.get_end_devices()
+        if bulbs is None:
+            return self.bulbs.values()
+
+        names = dict((bulb.name.lower(), bulb) for bulb in self.bulbs.values())
+        found = []
+        for bulb in bulbs:
+            if not isinstance(bulb, Bulb):
+                bulb = self.bulbs.get(bulb) or names.get(bulb.lower())
+            if bulb is not None:
+                found.append(bulb)
+        return found
+
+    def get_bulb_status(self, bulbs=None):
+        """
+        Reads the state of BULBS (every bulb by default) with a single request.
+        Returns the list of bulbs that were updated.
+        """
+        bulbs = self.get_bulbs(bulbs)
+        if not bulbs:
+            return []
+        response = self.send_action('BRIDGE', 'GET_DEVICE_STATUS',
+                                    ids=','.join(bulb.dev_id for bulb in bulbs))
+
+        updated = []
+        for status in DEVICE_STATUS_RE.findall(saxutils.unescape(xml_field(DEVICE_STATUS_LIST_RE, response))):
+            bulb = self.bulbs.get(xml_field(DEVICE_ID_RE, status))
+            if bulb is not None:
+                bulb.update(xml_field(CAPABILITY_ID_RE, status), xml_field(CAPABILITY_VALUE_RE, status))
+                updated.append(bulb)
+        return updated
+
+    def set_bulbs(self, changes):
+        """
+        Sends CHANGES, a list of (bulb, on, level) tuples, to the bridge as a single
+        request. ON is True or False and LEVEL a brightness from 0 to 255, either
+        may be None to leave it as it is. Returns the IDs of the bulbs the bridge
+        couldn't change.
+        """
+        statuses = []
+        for bulb, on, level in changes:
+            capabilities, values = Bulb.capability_values(on, level)
+            if capabilities:
+                statuses.append('<DeviceStatus><IsGroupAction>NO</IsGroupAction>' +\
+                                '<DeviceID available="YES">%s</DeviceID>' % bulb.dev_id +\
+                                '<CapabilityID>%s</CapabilityID>' % capabilities +\
+                                '<CapabilityValue>%s</CapabilityValue>' % values +\
+                                '</DeviceStatus>')
+        if not statuses:
+            return []
+
+        status_list = '<?xml version="1.0" encoding="UTF-8"?>' + ''.join(statuses)
+        with self.lock:
+            try:
+                response = self.send_action('BRIDGE', 'SET_DEVICE_STATUS',
+                                            status_list=saxutils.escape(status_list))
+            except Exception:
+                # The bulbs may or may not have changed.
+                self.invalidate_state()
+                raise
+
+            failed = [dev_id.strip() for dev_id in xml_field(ERROR_DEVICE_IDS_RE, response).split(',')
+                                     if dev_id.strip()]
+            for bulb, on, level in changes:
+                if bulb.dev_id not in failed:
+                    bulb.apply(on, level)
+            self.current_state = self.bulbs_state()
+        return failed
+
+    def bulbs_state(self):
+        """
+        Returns 'ON' if any bulb is on, 'OFF' otherwise.
+        """
+        if any(bulb.on for bulb in self.bulbs.values()):
+            return 'ON'
+        return 'OFF'
+
+    def get_current_state(self):
+        """
+        Overrides the base version, the state of a Link is that of its bulbs. It is
+        ON when any of them is on.
+        """
+        if self.bulbs:
+            self.get_bulb_status()
+        else:
+            self.get_end_devices()
+        return self.bulbs_state()
+
+    def turn_on(self, bulbs=None):
+        """
+        Turns BULBS (every bulb by default) on with a single request, see set_bulbs().
+        """
+        return self.set_bulbs([(bulb, True, None) for bulb in self.get_bulbs(bulbs)])
+
+    def turn_off(self, bulbs=None):
+        """
+        Turns BULBS (every bulb by default) off with a single request, see set_bulbs().
+        """
+        return self.set_bulbs([(bulb, False, None) for bulb in self.get_bulbs(bulbs)])
+
+    def toggle(self, bulbs=None):
+        """
+        Turns BULBS off if any of them is on, on otherwise.
+        """
+        with self.lock:
+            bulbs = self.get_bulbs(bulbs)
+            on = not any(bulb.on for bulb in bulbs)
+            return self.set_bulbs([(bulb, on, None) for bulb in bulbs])
+
+    def set_level(self, level, bulbs=None):
+        """
+        Sets the brightness of BULBS (every bulb by default) to LEVEL, from 0 to
+        255, with a single request.
+        """
+        return self.set_bulbs([(bulb, level > 0, level) for bulb in self.get_bulbs(bulbs)])
 
     @staticmethod
     def find_wemos():
@@ -457,3 +1780,386 @@ class Link(Wemo):
         return super(Link, Link).find_wemos("LINK")
 
 #} End of Wemo Link class
+
+
+
+# Bulb class {
+class Bulb(object):
+    """
+    A bulb paired with a Link. Its commands go through the bridge, use
+    Link.set_bulbs() to change several bulbs at once.
+    """
+
+    # Capabilities of the bulbs, as the bridge numbers them.
+    ON_OFF = '10006'
+    LEVEL = '10008'
+
+    # Tenths of a second a change of level takes.
+    transition = 0
+
+    __slots__ = ('link', 'dev_id', 'name', 'on', 'level')
+
+    def __init__(self, link, dev_id, name=''):
+        self.link = link
+        self.dev_id = dev_id
+        self.name = name
+        self.on = False
+        self.level = 255
+
+    def __str__(self):
+        return "%s - %s" % (self.name, self.dev_id)
+
+    @staticmethod
+    def capability_values(on, level):
+        """
+        Returns the CapabilityID and CapabilityValue lists that set ON and LEVEL.
+        """
+        capabilities, values = [], []
+        if on is not None:
+            capabilities.append(Bulb.ON_OFF)
+            values.append('1' if on else '0')
+        if level is not None:
+            capabilities.append(Bulb.LEVEL)
+            values.append('%d:%d' % (max(0, min(255, level)), Bulb.transition))
+        return ','.join(capabilities), ','.join(values)
+
+    def update(self, capabilities, values):
+        """
+        Reads the bulb's state from the comma separated CAPABILITIES and VALUES the
+        bridge reports.
+        """
+        state = dict(zip(capabilities.split(','), values.split(',')))
+        if state.get(Bulb.ON_OFF):
+            self.on = state[Bulb.ON_OFF].strip() == '1'
+        level = state.get(Bulb.LEVEL, '').split(':')[0].strip()
+        if level.isdigit():
+            self.level = int(level)
+
+    def apply(self, on, level):
+        """
+        Records a change the bridge has taken.
+        """
+        if on is not None:
+            self.on = on
+        if level is not None:
+            self.level = max(0, min(255, level))
+
+    @property
+    def current_state(self):
+        return 'ON' if self.on else 'OFF'
+
+    def turn_on(self):
+        return self.link.set_bulbs([(self, True, None)])
+
+    def turn_off(self):
+        return self.link.set_bulbs([(self, False, None)])
+
+    def toggle(self):
+        with self.link.lock:
+            return self.link.set_bulbs([(self, not self.on, None)])
+
+    def set_level(self, level):
+        """
+        Sets the brightness to LEVEL, from 0 to 255. A LEVEL of 0 turns the bulb off.
+        """
+        return self.link.set_bulbs([(self, level > 0, level)])
+
+#} End of Bulb class
+
+
+
+# Wemo Group class {
+class Group(object):
+    """
+    A set of Wemo devices that are commanded together. Each command is sent to
+    every device concurrently, so a group command takes about as long as the
+    slowest device instead of the sum of all of them.
+    """
+
+    max_workers = 16
+
+    def __init__(self, devices, max_workers=None):
+        """
+        Initialize the group with a list of DEVICES. MAX_WORKERS caps the number of
+        devices that are talked to at the same time.
+        """
+        self.devices = list(devices)
+        if max_workers is not None:
+            self.max_workers = max_workers
+
+    def __len__(self):
+        return len(self.devices)
+
+    def call(self, method, *args):
+        """
+        Runs METHOD on every device in the group. Returns a list of
+        (device, result, error) tuples, see run_concurrently().
+        """
+        return run_concurrently(lambda dev: getattr(dev, method)(*args),
+                                self.devices, self.max_workers)
+
+    def turn_on(self):
+        return self.call('turn_on')
+
+    def turn_off(self):
+        return self.call('turn_off')
+
+    def toggle(self):
+        return self.call('toggle')
+
+    def get_current_state(self):
+        return self.call('get_current_state')
+
+    def get_friendly_name(self):
+        return self.call('get_friendly_name')
+
+    def prime(self):
+        """
+        Reads the name and state of every device that doesn't know them yet, all
+        at once. The devices that failed have an error in their result.
+        """
+        return self.call('prime')
+
+#} End of Wemo Group class
+
+
+
+# NotifyHandler {
+class NotifyHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Handles the NOTIFY requests that subscribed Wemos send to the EventListener.
+    """
+
+    def do_NOTIFY(self):
+        length = int(self.headers.getheader('content-length', 0))
+        body = self.rfile.read(length)
+        self.server.listener.notify(self.headers.getheader('sid', ''), body)
+
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        # Stay quiet, the daemon has no terminal to write to.
+        pass
+
+#} End of NotifyHandler
+
+
+class ThreadedHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    HTTP server that handles each request on its own thread.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+
+# EventListener {
+class EventListener(object):
+    """
+    Subscribes to the basicevent1 service of Wemo devices and listens for the
+    NOTIFY messages they send when their state changes. Each device's
+    current_state is updated as the messages arrive, so it does not have to be
+    polled. Subscriptions are renewed before they expire.
+    """
+
+    path = '/upnp/event/basicevent1'
+
+    def __init__(self, host=None, port=0, timeout=300, renew_margin=30):
+        """
+        Initialize the listener. It listens on HOST:PORT, which defaults to every
+        interface and a free port. Devices are asked to keep subscriptions
+        for TIMEOUT seconds and they are renewed RENEW_MARGIN seconds early.
+        """
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.renew_margin = renew_margin
+
+        # SID -> device
+        self.devices = {}
+        # (ip, port) -> [SID, expire time, next renew time]
+        self.subscriptions = {}
+
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        # Wakes the renew loop when a subscription is added or it should stop.
+        self.changed = threading.Event()
+        self.server = None
+
+    def start(self):
+        """
+        Starts listening for events and renewing subscriptions.
+        """
+        if self.host is None:
+            self.host = '0.0.0.0'
+        self.server = ThreadedHTTPServer((self.host, self.port), NotifyHandler)
+        self.server.listener = self
+        self.port = self.server.server_address[1]
+        self.stopped.clear()
+
+        for target in (self.server.serve_forever, self.renew_loop):
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+
+    def stop(self):
+        """
+        Stops the listener. Subscriptions are left to expire on the devices.
+        """
+        self.stopped.set()
+        self.changed.set()
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def send(self, dev, method, headers):
+        """
+        Sends an event request METHOD with the extra HEADERS to DEV. Returns the
+        status code and the response.
+        """
+        message = '%s %s HTTP/1.1\r\n' % (method, self.path) +\
+                  'HOST: %s:%s\r\n' % (dev.ip, dev.port) +\
+                  headers +\
+                  'Content-Length: 0\r\n\r\n'
+        response = dev.send_to_wemo(message, method.lower())
+        status = response.split(' ', 2)
+        if len(status) > 1 and status[1].isdigit():
+            return int(status[1]), response
+        return 0, response
+
+    def subscribe(self, dev):
+        """
+        Subscribes to the events of DEV. Returns the subscription ID, or None if the
+        device refused.
+        """
+        status, response = self.send(dev, 'SUBSCRIBE',
+                               'CALLBACK: <http://%s:%s/>\r\n' % (self.callback_host(dev), self.port) +\
+                               'NT: upnp:event\r\n' +\
+                               'TIMEOUT: Second-%d\r\n' % self.timeout)
+        sid = SID_RE.search(response)
+        if status != 200 or not sid:
+            return None
+        self.add_subscription(dev, sid.group(1), response)
+        return sid.group(1)
+
+    def callback_host(self, dev):
+        """
+        Returns the address DEV should send its events to. When listening on every
+        interface, that is the address of the interface the route to DEV goes
+        out of, so devices on other interfaces and VLANs can reach it too.
+        """
+        if self.host not in ('', '0.0.0.0'):
+            return self.host
+        # Connecting a UDP socket only picks the route, nothing is sent.
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            sock.connect((dev.ip, dev.port))
+            return sock.getsockname()[0]
+        except socket.error:
+            return Wemo.get_active_iface_addr()
+        finally:
+            sock.close()
+
+    def renew(self, addr):
+        """
+        Renews the subscription for the device at ADDR. A new subscription is made
+        if the device has forgotten the old one.
+        """
+        # The subscription may have been dropped by sync() since it came due.
+        with self.lock:
+            sub = self.subscriptions.get(addr)
+            dev = self.devices.get(sub[0]) if sub else None
+        if dev is None:
+            return None
+        sid = sub[0]
+        status, response = self.send(dev, 'SUBSCRIBE',
+                               'SID: %s\r\n' % sid +\
+                               'TIMEOUT: Second-%d\r\n' % self.timeout)
+        if status == 200:
+            self.add_subscription(dev, sid, response)
+            return sid
+
+        with self.lock:
+            self.devices.pop(sid, None)
+            self.subscriptions.pop(addr, None)
+        return self.subscribe(dev)
+
+    def unsubscribe(self, addr):
+        """
+        Cancels the subscription for the device at ADDR.
+        """
+        with self.lock:
+            sub = self.subscriptions.pop(addr, None)
+            dev = self.devices.pop(sub[0], None) if sub else None
+        if dev:
+            self.send(dev, 'UNSUBSCRIBE', 'SID: %s\r\n' % sub[0])
+
+    def add_subscription(self, dev, sid, response):
+        """
+        Records the subscription SID for DEV using the timeout in RESPONSE.
+        """
+        timeout = SUB_TIMEOUT_RE.search(response)
+        timeout = int(timeout.group(1)) if timeout else self.timeout
+        expires = time.time() + timeout
+        with self.lock:
+            self.devices[sid] = dev
+            self.subscriptions[(dev.ip, dev.port)] = [sid, expires,
+                                                      expires - min(self.renew_margin, timeout / 2.0)]
+        self.changed.set()
+
+    def sync(self, devices):
+        """
+        Makes DEVICES the set of subscribed devices. New devices are subscribed,
+        missing ones unsubscribed, and devices that were rebuilt at the same
+        address take over the existing subscription.
+        """
+        current = dict(((dev.ip, dev.port), dev) for dev in devices)
+        with self.lock:
+            for sid, dev in self.devices.items():
+                if (dev.ip, dev.port) in current:
+                    self.devices[sid] = current[(dev.ip, dev.port)]
+            new = [dev for addr, dev in current.items() if addr not in self.subscriptions]
+            gone = [addr for addr in self.subscriptions if addr not in current]
+
+        run_concurrently(self.subscribe, new)
+        run_concurrently(self.unsubscribe, gone)
+
+    def notify(self, sid, body):
+        """
+        Handles an event message BODY sent for the subscription SID.
+        """
+        with self.lock:
+            dev = self.devices.get(sid)
+        state = BINARY_STATE_RE.search(body)
+        if dev and state:
+            dev.handle_event(Wemo.parse_state(state.group(1)))
+
+    def renew_loop(self):
+        """
+        Renews subscriptions as they come due until the listener is stopped.
+        """
+        while not self.stopped.is_set():
+            now = time.time()
+            with self.lock:
+                due = [addr for addr, sub in self.subscriptions.items() if sub[2] <= now]
+
+            for addr in due:
+                try:
+                    self.renew(addr)
+                except Exception:
+                    # Try again shortly, the device may be back by then. Whatever
+                    # went wrong, the other subscriptions still need renewing.
+                    with self.lock:
+                        if addr in self.subscriptions:
+                            self.subscriptions[addr][2] = time.time() + 10
+
+            with self.lock:
+                wake = min([sub[2] for sub in self.subscriptions.values()] or
+                           [time.time() + self.timeout])
+            self.changed.wait(max(1.0, wake - time.time()))
+            self.changed.clear()
+
+#} End of EventListener
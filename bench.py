@@ -0,0 +1,294 @@
+#!/usr/bin/python -B
+################################################################################
+# Copyright (c) 2013 Phil Smith
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+################################################################################
+################################################################################
+# @Title: bench.py
+#
+# @Author: Phil Smith
+#
+# @Date: 17-Oct-2026 9:40 AM
+#
+# @Project: Wemo
+#
+# @Purpose: Measures discovery, command latency and fan-out throughput against
+#           a simulated fleet of devices.
+#
+################################################################################
+import os
+import imp
+import sys
+import json
+import time
+import Wemo
+import client
+import shutil
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess as sp
+import os.path as op
+
+HERE = op.dirname(op.abspath(__file__))
+
+
+def percentile(samples, pct):
+    """
+    Returns the PCT percentile of SAMPLES.
+    """
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100.0))]
+
+
+def summarize(samples):
+    """
+    Returns the count, mean and percentiles, in milliseconds, of SAMPLES
+    given in seconds.
+    """
+    if not samples:
+        return { "count": 0 }
+    ms = lambda value: round(value * 1000, 3)
+    return { "count": len(samples),
+             "mean_ms": ms(sum(samples) / len(samples)),
+             "p50_ms": ms(percentile(samples, 50)),
+             "p95_ms": ms(percentile(samples, 95)),
+             "p99_ms": ms(percentile(samples, 99)),
+             "max_ms": ms(max(samples)) }
+
+
+def timed(func, *args):
+    """
+    Returns the seconds it took to call FUNC with ARGS.
+    """
+    start = time.time()
+    func(*args)
+    return time.time() - start
+
+
+
+# Fleet {
+class Fleet(object):
+    """
+    A wemo_sim.py process serving COUNT devices.
+    """
+
+    def __init__(self, count, sim_args):
+        self.proc = sp.Popen([sys.executable, op.join(HERE, "wemo_sim.py"),
+                              "--count", str(count)] + sim_args,
+                             stdout=sp.PIPE, cwd=HERE)
+        line = self.proc.stdout.readline()
+        if not line:
+            raise RuntimeError("Simulator did not start.")
+        info = json.loads(line)
+        self.ssdp_address = tuple(info["ssdp"])
+        self.devices = info["devices"]
+
+    def stop(self):
+        self.proc.terminate()
+        self.proc.wait()
+
+#} End of Fleet
+
+
+
+def bench_discovery(fleet):
+    """
+    Times an SSDP search that finds the whole fleet.
+    """
+    start = time.time()
+    found = Wemo.Wemo.find_all_wemos(["SOCKET"], deadline=10.0, expected=len(fleet.devices),
+                                     address=fleet.ssdp_address)
+    return { "seconds": round(time.time() - start, 4),
+             "found": len(found["SOCKET"]),
+             "expected": len(fleet.devices) }
+
+
+def bench_commands(devices, iterations):
+    """
+    Times single commands sent to one device, then the same commands fanned
+    out to every device with a Group.
+    """
+    dev = devices[0]
+    latencies = [timed(dev.toggle) for i in range(iterations)]
+
+    group = Wemo.Group(devices)
+    rounds = max(1, iterations / 10)
+    start = time.time()
+    errors = 0
+    for i in range(rounds):
+        errors += sum(1 for item, result, error in group.toggle() if error)
+    elapsed = time.time() - start
+
+    return { "single": summarize(latencies),
+             "fanout": { "rounds": rounds,
+                         "devices": len(devices),
+                         "errors": errors,
+                         "round_ms": round(elapsed / rounds * 1000, 3),
+                         "commands_per_second": round(rounds * len(devices) / elapsed, 1) } }
+
+
+def bench_daemon(fleet, iterations):
+    """
+    Runs wemod in this process against the fleet and times requests sent
+    through its control endpoint.
+    """
+    wemod = imp.load_source("wemod", op.join(HERE, "wemod"))
+    tmp = tempfile.mkdtemp(prefix="wemo_bench")
+    serv = wemod.Server()
+    serv.rx_endpoint = op.join(tmp, "in")
+    serv.tx_endpoint = op.join(tmp, "out")
+    serv.ctl_endpoint = op.join(tmp, "ctl")
+    serv.cache = wemod.DeviceCache(op.join(tmp, "devices.db"))
+    serv.ssdp_address = fleet.ssdp_address
+    serv.metrics_port = None
+    serv.events = Wemo.EventListener(host="127.0.0.1")
+
+    thread = threading.Thread(target=serv.serve)
+    thread.daemon = True
+    start = time.time()
+    thread.start()
+
+    cli = client.Client(serv.ctl_endpoint)
+    try:
+        while True:
+            try:
+                cli.connect()
+                break
+            except socket.error:
+                time.sleep(0.01)
+        # The first answer comes once the device list is built.
+        while len(cli.send("list_cmd").get("devices", [])) < len(fleet.devices) and \
+              time.time() - start < 30:
+            time.sleep(0.05)
+        startup = time.time() - start
+
+        # Friendly names may contain spaces, the address never does.
+        addr = cli.send("list_cmd")["devices"][0]["address"]
+        # Both ways of sending commands share process_cmds().
+        checked = check_daemon(serv, cli, thread,
+                               ["on_cmd %s" % addr, "off_cmd all", "toggle_cmd %s" % addr,
+                                "scene_cmd nothing", "list_cmd",
+                                [["on_cmd", addr]], [["scene_cmd", "nothing"], ["toggle_cmd", "all"]],
+                                "cancel_cmd", "at_cmd", [["cancel_cmd"]], [["at_cmd"]], [["every_cmd"]],
+                                [["scene_set_cmd"]], [["scene_del_cmd"]], [["stats_cmd", "x"]]])
+
+        single = [timed(cli.send, "toggle_cmd", addr) for i in range(iterations)]
+        rounds = max(1, iterations / 10)
+        fanout = [timed(cli.send, "toggle_cmd", "all") for i in range(rounds)]
+        batch = [timed(cli.request, [["toggle_cmd", addr]] * 10) for i in range(rounds)]
+        cli.send("quit_cmd")
+    finally:
+        cli.close()
+        # quit() removes the endpoints itself, let it finish first.
+        thread.join(5)
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    return { "startup_seconds": round(startup, 4),
+             "checks": checked,
+             "single": summarize(single),
+             "fanout": summarize(fanout),
+             "batch_of_10": summarize(batch) }
+
+
+def check_daemon(serv, cli, thread, probes):
+    """
+    Sends each of PROBES, a list of commands, to the daemon: as a datagram on the
+    legacy endpoint when it's a string, as a framed request otherwise. Raises
+    RuntimeError if the daemon stops answering after one of them.
+    """
+    legacy = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    cli.sock.settimeout(5.0)
+    try:
+        for probe in probes:
+            try:
+                if isinstance(probe, str):
+                    legacy.sendto(probe, serv.rx_endpoint)
+                else:
+                    cli.request(probe)
+                cli.send("list_cmd")
+            except (socket.error, ValueError) as err:
+                raise RuntimeError("wemod stopped answering after %r: %s" % (probe, err))
+            if not thread.is_alive():
+                raise RuntimeError("wemod died after %r" % (probe,))
+    finally:
+        legacy.close()
+        cli.sock.settimeout(cli.timeout)
+    return len(probes)
+
+
+def run(sizes, iterations, sim_args, daemon=True):
+    """
+    Runs every benchmark once for each fleet size in SIZES.
+    """
+    results = []
+    for size in sizes:
+        fleet = Fleet(size, sim_args)
+        try:
+            result = { "devices": size, "discovery": bench_discovery(fleet) }
+
+            # Building the handles costs no I/O, priming reads every name and state.
+            start = time.time()
+            devices = [Wemo.Socket(info["location"], info["udn"]) for info in fleet.devices]
+            built = time.time() - start
+            start = time.time()
+            primed = Wemo.Group(devices, 32).prime()
+            result["build"] = { "built": len(devices),
+                                "build_ms": round(built * 1000, 3),
+                                "prime_ms": round((time.time() - start) * 1000, 3),
+                                "primed": sum(1 for dev, ret, error in primed if error is None) }
+            result.update(bench_commands(devices, iterations))
+
+            if daemon:
+                result["daemon"] = bench_daemon(fleet, iterations)
+        finally:
+            fleet.stop()
+        results.append(result)
+    return results
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Benchmark against simulated WeMo devices.")
+    parser.add_argument("--sizes", default="10,50,200", help="comma separated fleet sizes")
+    parser.add_argument("--iterations", type=int, default=100, help="commands per measurement")
+    parser.add_argument("--no-daemon", action="store_true", help="skip the wemod measurements")
+    parser.add_argument("--output", help="write the JSON results to this file")
+    parser.add_argument("sim_args", nargs=argparse.REMAINDER,
+                        help="arguments passed on to wemo_sim.py, after --")
+    args = parser.parse_args()
+
+    sim_args = [arg for arg in args.sim_args if arg != "--"]
+    report = { "python": sys.version.split()[0],
+               "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+               "iterations": args.iterations,
+               "simulator": sim_args,
+               "results": run([int(size) for size in args.sizes.split(",")],
+                              args.iterations, sim_args, not args.no_daemon) }
+
+    data = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as out:
+            out.write(data + "\n")
+    else:
+        print data
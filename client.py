@@ -32,67 +32,133 @@
 # @Purpose: Client test app.
 #
 ################################################################################
-import os
+import json
+import collections
+import errno
 import socket
+import struct
 import os.path as op
 
 class Client(object):
   """
-  Client class for local socket test.
+  Client for the wemod control socket. Commands are sent to the daemon in
+  batches and each batch is answered with the result of every command.
   """
 
-  def __init__(self):
+  def __init__(self, endpoint="/tmp/wemo_srv_ctl", timeout=30.0):
     """
     Initialize structures.
     """
-    self.tx_socket = socket.socket( socket.AF_UNIX, socket.SOCK_DGRAM )
-    self.rx_socket = socket.socket( socket.AF_UNIX, socket.SOCK_DGRAM )
-    # Transmit to the server input
-    self.tx_endpoint = "/tmp/wemo_srv_in"
-    # Receive from the server output
-    self.rx_endpoint = "/tmp/wemo_srv_out"
+    self.endpoint = endpoint
+    self.timeout = timeout
+    self.sock = None
+    self.next_id = 1
+    # Streamed frames that arrived while waiting for a reply, see watch().
+    self.events = collections.deque(maxlen=4096)
 
 
-  def test_connect(self):
+  def connect(self):
+    """
+    Connects this app to the daemon.
+    """
+    if not op.exists( self.endpoint ):
+      raise socket.error(errno.ENOENT, "Endpoint does not exist.")
 
-    if not op.exists( self.tx_endpoint ):
-      print "Endpoint does not exist."
-      return
+    self.sock = socket.socket( socket.AF_UNIX, socket.SOCK_STREAM )
+    self.sock.settimeout( self.timeout )
+    self.sock.connect( self.endpoint )
 
-    self.tx_socket.connect(self.tx_endpoint)
-    # Commands will also take the wemo's friendly name
-    # e.g. self.tx_socket.send("off_cmd crockpot")
-    self.tx_socket.send("on_cmd all")
-    self.tx_socket.send("list_cmd")
 
-    raw_data = self.rx_socket.recv( 4096 )
-    if raw_data:
-      print raw_data
+  def close(self):
+    """
+    Disconnects from the daemon.
+    """
+    if self.sock:
+      self.sock.close()
+      self.sock = None
 
 
-  def connect_rx(self):
+  def request(self, cmds):
     """
-    Connects this app to it's rx socket.
+    Sends CMDS, a list of commands such as [["on_cmd", "lamp"], ["list_cmd"]],
+    in a single message. Returns the list of results, one for each command.
+    Results of device commands have a "devices" list with the outcome, state
+    and latency for every device the command applied to.
     """
+    req_id = self.next_id
+    self.next_id += 1
+
+    data = json.dumps({"id": req_id, "cmds": cmds})
+    self.sock.sendall(struct.pack('!I', len(data)) + data)
 
-    # Socket already in use will return socket.error(98)
-    # Get rid of it before trying to connect.
-    # Note: must check for 'exists' no 'isfile' because sockets
-    #       are not "files".
-    if op.exists( self.rx_endpoint ):
-      os.remove( self.rx_endpoint )
+    while True:
+      reply = self.recv_frame()
+      if reply.get("event"):
+        self.events.append(reply)
+        continue
+      if reply.get("error"):
+        raise ValueError(reply["error"])
+      if reply.get("id") == req_id:
+        return reply["results"]
 
-    self.rx_socket = socket.socket( socket.AF_UNIX, socket.SOCK_DGRAM )
 
-    try:
-      self.rx_socket.bind( self.rx_endpoint )
-    except Exception as e:
-      print e.args
-      print "Could not connect to socket: %s" % self.rx_endpoint
-      exit(1)
+  def send(self, cmd_name, args=""):
+    """
+    Sends the command CMD_NAME with the whitespace separated ARGS. Returns the
+    command's result.
+    """
+    return self.request([[cmd_name] + args.split()])[0]
+
+
+  def watch(self, devices="all"):
+    """
+    Asks the daemon to stream the power samples of the Insight DEVICES, whitespace
+    separated. Yields each sample as it arrives, including those that arrived
+    while other commands were sent.
+    """
+    self.send("watch_cmd", devices)
+    while True:
+      while self.events:
+        yield self.events.popleft()
+      frame = self.recv_frame()
+      if frame.get("event"):
+        yield frame
+
+
+  def recv_frame(self):
+    """
+    Reads one length-prefixed JSON message from the daemon.
+    """
+    length = struct.unpack('!I', self.recv_exactly(4))[0]
+    return json.loads(self.recv_exactly(length))
+
+
+  def recv_exactly(self, size):
+    """
+    Reads exactly SIZE bytes from the daemon.
+    """
+    data = ''
+    while len(data) < size:
+      chunk = self.sock.recv(size - len(data))
+      if not chunk:
+        raise socket.error(errno.ECONNRESET, "Daemon closed the connection.")
+      data += chunk
+    return data
 
 
 if __name__ == "__main__":
   cli = Client()
-  cli.connect_rx()
-  cli.test_connect()
+  try:
+    cli.connect()
+  except socket.error as err:
+    print err.args[1]
+    exit(1)
+
+  # Commands will also take the wemo's friendly name
+  # e.g. cli.send("off_cmd", "crockpot")
+  results = cli.request([["on_cmd", "all"], ["list_cmd"]])
+
+  for dev in results[0]["devices"]:
+    print "%s: %s (%s ms)" % (dev["device"], dev["state"] if dev["ok"] else dev["error"],
+                              dev["latency_ms"])
+  print " ".join("[%s]" % dev["name"] for dev in results[1]["devices"])
@@ -0,0 +1,516 @@
+#!/usr/bin/python -B
+################################################################################
+# Copyright (c) 2013 Phil Smith
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+################################################################################
+################################################################################
+# @Title: wemo_sim.py
+#
+# @Author: Phil Smith
+#
+# @Date: 17-Oct-2026 9:12 AM
+#
+# @Project: Wemo
+#
+# @Purpose: Simulates a fleet of WeMo devices on the local host.
+#
+################################################################################
+import re
+import sys
+import json
+import time
+import Wemo
+import random
+import select
+import signal
+import socket
+import argparse
+import threading
+import collections
+import xml.sax.saxutils as saxutils
+
+SETUP_XML = '<?xml version="1.0"?>\n' +\
+            '<root xmlns="urn:Belkin:device-1-0">\n' +\
+            '<specVersion><major>1</major><minor>0</minor></specVersion>\n' +\
+            '<device>\n' +\
+            '<deviceType>%(device_type)s</deviceType>\n' +\
+            '<friendlyName>%(name)s</friendlyName>\n' +\
+            '<manufacturer>Belkin International Inc.</manufacturer>\n' +\
+            '<modelName>%(model)s</modelName>\n' +\
+            '<UDN>%(udn)s</UDN>\n' +\
+            '</device>\n' +\
+            '</root>'
+
+SOAP_RESPONSE = '<s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/" s:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/"><s:Body>\n' +\
+                '<u:%(action)sResponse xmlns:u="urn:Belkin:service:%(service)s:1">\n' +\
+                '%(result)s\n' +\
+                '</u:%(action)sResponse>\n' +\
+                '</s:Body> </s:Envelope>'
+
+NOTIFY_BODY = '<e:propertyset xmlns:e="urn:schemas-upnp-org:event-1-0">' +\
+              '<e:property><BinaryState>%d</BinaryState></e:property>' +\
+              '</e:propertyset>'
+
+SOAP_ACTION_RE = re.compile(r'^soapaction:\s*"?[^#"]*#(\w+)', re.IGNORECASE | re.MULTILINE)
+CALLBACK_RE = re.compile(r'^callback:\s*<([^>]*)>', re.IGNORECASE | re.MULTILINE)
+HEADER_SID_RE = re.compile(r'^sid:\s*(\S+)', re.IGNORECASE | re.MULTILINE)
+LENGTH_RE = re.compile(r'^content-length:\s*(\d+)', re.IGNORECASE | re.MULTILINE)
+ST_HEADER_RE = re.compile(r'^st:\s*(\S+)', re.IGNORECASE | re.MULTILINE)
+DEVICE_IDS_RE = re.compile(r'<DeviceIDs>(.*?)</DeviceIDs>')
+
+
+class Faults(object):
+    """
+    Faults injected into the simulated devices' responses.
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, split=0, drop=0.0,
+                 slow_fraction=0.0, slow_latency=0.0, seed=None):
+        """
+        LATENCY (plus up to JITTER) seconds are added to every response. SPLIT, if
+        set, sends responses in pieces of that many bytes. DROP is the chance
+        that a request or search goes unanswered. SLOW_FRACTION of the devices
+        add another SLOW_LATENCY seconds.
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.split = split
+        self.drop = drop
+        self.slow_fraction = slow_fraction
+        self.slow_latency = slow_latency
+        self.random = random.Random(seed)
+
+    def dropped(self):
+        return self.drop and self.random.random() < self.drop
+
+
+
+# FakeWemo {
+class FakeWemo(object):
+    """
+    One simulated device. It serves /setup.xml, the basicevent1 actions and
+    event subscriptions over keep-alive HTTP/1.1 connections.
+    """
+
+    models = { "SOCKET": "Socket", "SENSOR": "Sensor", "LINK": "Bridge", "INSIGHT": "Insight" }
+
+    bulbs_per_link = 8
+
+    def __init__(self, index, dev_type, host, faults):
+        self.index = index
+        self.dev_type = dev_type
+        self.model = FakeWemo.models.get(dev_type, dev_type.title())
+        self.name = "Sim %s %d" % (self.model, index)
+        self.udn = "uuid:%s-1_0-SIM%05d" % (self.model, index)
+        self.faults = faults
+        self.state = 0
+        self.last_change = int(time.time())
+        # mW seconds drawn so far, for a simulated Insight.
+        self.energy = 0.0
+
+        # Bulb ID -> [name, on, level] for a simulated Link.
+        self.bulbs = collections.OrderedDict()
+        if dev_type == "LINK":
+            for i in range(FakeWemo.bulbs_per_link):
+                self.bulbs["94103EA2B2%06d" % (index * 100 + i)] = ["Sim Bulb %d.%d" % (index, i), 0, 255]
+
+        self.latency = faults.latency
+        if faults.random.random() < faults.slow_fraction:
+            self.latency += faults.slow_latency
+
+        # SID -> callback URL
+        self.subscribers = {}
+        self.next_sid = 1
+        self.lock = threading.Lock()
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, 0))
+        self.sock.listen(32)
+        self.host, self.port = self.sock.getsockname()
+
+    def location(self):
+        return "http://%s:%d/setup.xml" % (self.host, self.port)
+
+    def search_target(self):
+        return Wemo.Wemo.search_targets.get(self.dev_type, "urn:Belkin:device:%s:1" % self.dev_type.lower())
+
+    def handle(self, conn):
+        """
+        Serves the requests that arrive on CONN until the client closes it.
+        """
+        buf = ''
+        try:
+            while True:
+                while '\r\n\r\n' not in buf:
+                    data = conn.recv(4096)
+                    if not data:
+                        return
+                    buf += data
+                head, buf = buf.split('\r\n\r\n', 1)
+                length = LENGTH_RE.search(head)
+                length = int(length.group(1)) if length else 0
+                while len(buf) < length:
+                    data = conn.recv(4096)
+                    if not data:
+                        return
+                    buf += data
+                body, buf = buf[:length], buf[length:]
+
+                if self.faults.dropped():
+                    return
+
+                delay = self.latency + self.faults.random.random() * self.faults.jitter
+                if delay:
+                    time.sleep(delay)
+
+                self.send(conn, self.respond(head, body))
+                if re.search(r'^connection:\s*close', head, re.IGNORECASE | re.MULTILINE):
+                    return
+        except socket.error:
+            return
+        finally:
+            conn.close()
+
+    def send(self, conn, data):
+        """
+        Sends DATA, in pieces if the faults call for it.
+        """
+        if not self.faults.split:
+            conn.sendall(data)
+            return
+        for i in range(0, len(data), self.faults.split):
+            conn.sendall(data[i:i + self.faults.split])
+            time.sleep(0.001)
+
+    @staticmethod
+    def response(status, body='', headers=''):
+        return 'HTTP/1.1 %s\r\n' % status +\
+               headers +\
+               'Content-Type: text/xml; charset="utf-8"\r\n' +\
+               'Content-Length: %d\r\n\r\n' % len(body) +\
+               body
+
+    def respond(self, head, body):
+        """
+        Returns the response to the request HEAD, BODY.
+        """
+        method, path = head.split(' ', 2)[:2]
+
+        if method == 'GET' and path == '/setup.xml':
+            return FakeWemo.response('200 OK', SETUP_XML % { "device_type": self.search_target(),
+                                                              "name": self.name,
+                                                              "model": self.model,
+                                                              "udn": self.udn })
+
+        if method == 'POST' and path == '/upnp/control/basicevent1':
+            action = SOAP_ACTION_RE.search(head)
+            action = action.group(1) if action else ''
+            if action == 'GetBinaryState':
+                result = '<BinaryState>%d</BinaryState>' % self.state
+            elif action == 'SetBinaryState':
+                state = Wemo.BINARY_STATE_RE.search(body)
+                if state:
+                    self.set_state(1 if '1' in state.group(1) else 0)
+                result = '<BinaryState>%d</BinaryState>' % self.state
+            elif action == 'GetFriendlyName':
+                result = '<FriendlyName>%s</FriendlyName>' % self.name
+            else:
+                return FakeWemo.response('500 Internal Server Error')
+            return FakeWemo.response('200 OK', SOAP_RESPONSE % { "action": action, "result": result,
+                                                                  "service": "basicevent" })
+
+        if method == 'POST' and path == '/upnp/control/insight1' and self.dev_type == "INSIGHT":
+            action = SOAP_ACTION_RE.search(head)
+            if not action or action.group(1) != 'GetInsightParams':
+                return FakeWemo.response('500 Internal Server Error')
+            result = '<InsightParams>%s</InsightParams>' % self.insight_params()
+            return FakeWemo.response('200 OK', SOAP_RESPONSE % { "action": "GetInsightParams",
+                                                                  "result": result,
+                                                                  "service": "insight" })
+
+        if method == 'POST' and path == '/upnp/control/bridge1' and self.bulbs:
+            action = SOAP_ACTION_RE.search(head)
+            action = action.group(1) if action else ''
+            if action == 'GetEndDevices':
+                result = '<DeviceLists>%s</DeviceLists>' % saxutils.escape(self.device_lists())
+            elif action == 'GetDeviceStatus':
+                ids = Wemo.xml_field(DEVICE_IDS_RE, body).split(',')
+                result = '<DeviceStatusList>%s</DeviceStatusList>' % saxutils.escape(self.status_list(ids))
+            elif action == 'SetDeviceStatus':
+                failed = self.set_device_status(saxutils.unescape(Wemo.xml_field(Wemo.DEVICE_STATUS_LIST_RE, body)))
+                result = '<ErrorDeviceIDs>%s</ErrorDeviceIDs>' % ','.join(failed)
+            else:
+                return FakeWemo.response('500 Internal Server Error')
+            return FakeWemo.response('200 OK', SOAP_RESPONSE % { "action": action, "result": result,
+                                                                  "service": "bridge" })
+
+        if method == 'SUBSCRIBE' and path == '/upnp/event/basicevent1':
+            sid = HEADER_SID_RE.search(head)
+            callback = CALLBACK_RE.search(head)
+            with self.lock:
+                if sid:
+                    sid = sid.group(1)
+                    if sid not in self.subscribers:
+                        return FakeWemo.response('412 Precondition Failed')
+                elif callback:
+                    sid = 'uuid:sim-%d-%d' % (self.index, self.next_sid)
+                    self.next_sid += 1
+                    self.subscribers[sid] = callback.group(1)
+                else:
+                    return FakeWemo.response('412 Precondition Failed')
+            return FakeWemo.response('200 OK', headers='SID: %s\r\nTIMEOUT: Second-300\r\n' % sid)
+
+        if method == 'UNSUBSCRIBE':
+            sid = HEADER_SID_RE.search(head)
+            with self.lock:
+                if sid:
+                    self.subscribers.pop(sid.group(1), None)
+            return FakeWemo.response('200 OK')
+
+        return FakeWemo.response('404 Not Found')
+
+    def insight_params(self):
+        """
+        Returns an InsightParams value, drawing 40 to 60 W while on.
+        """
+        now = int(time.time())
+        power = int(40000 + self.faults.random.random() * 20000) if self.state else 0
+        on_for = now - self.last_change if self.state else 0
+        energy = int(self.energy / 60.0)
+        return '|'.join(str(field) for field in
+                        (self.state, self.last_change, on_for, on_for, on_for, 1209600,
+                         power, power, energy, energy, 8000))
+
+    def device_lists(self):
+        """
+        Returns the list of paired bulbs, as a Link answers GetEndDevices.
+        """
+        infos = ''.join('<DeviceInfo><DeviceIndex>%d</DeviceIndex><DeviceID>%s</DeviceID>'
+                        '<FriendlyName>%s</FriendlyName><CapabilityIDs>10006,10008,30008,30009,3000A</CapabilityIDs>'
+                        '<CurrentState>%d,%d:0,,,</CurrentState></DeviceInfo>' % (i, dev_id, name, on, level)
+                        for i, (dev_id, (name, on, level)) in enumerate(self.bulbs.items()))
+        return '<?xml version="1.0" encoding="utf-8"?><DeviceLists><DeviceList><DeviceListType>Paired</DeviceListType>' +\
+               '<DeviceInfos>%s</DeviceInfos></DeviceList></DeviceLists>' % infos
+
+    def status_list(self, ids):
+        """
+        Returns the status of the bulbs in IDS, as a Link answers GetDeviceStatus.
+        """
+        return '<?xml version="1.0" encoding="utf-8"?><DeviceStatusList>' +\
+               ''.join('<DeviceStatus><IsGroupAction>NO</IsGroupAction><DeviceID available="YES">%s</DeviceID>'
+                       '<CapabilityID>10006,10008</CapabilityID><CapabilityValue>%d,%d:0</CapabilityValue>'
+                       '</DeviceStatus>' % (dev_id, self.bulbs[dev_id][1], self.bulbs[dev_id][2])
+                       for dev_id in ids if dev_id in self.bulbs) +\
+               '</DeviceStatusList>'
+
+    def set_device_status(self, status_list):
+        """
+        Applies every DeviceStatus in STATUS_LIST. Returns the IDs of unknown bulbs.
+        """
+        failed = []
+        for status in Wemo.DEVICE_STATUS_RE.findall(status_list):
+            dev_id = Wemo.xml_field(Wemo.DEVICE_ID_RE, status)
+            if dev_id not in self.bulbs:
+                failed.append(dev_id)
+                continue
+            values = dict(zip(Wemo.xml_field(Wemo.CAPABILITY_ID_RE, status).split(','),
+                              Wemo.xml_field(Wemo.CAPABILITY_VALUE_RE, status).split(',')))
+            if '10006' in values:
+                self.bulbs[dev_id][1] = int(values['10006'])
+            if '10008' in values:
+                self.bulbs[dev_id][2] = int(values['10008'].split(':')[0])
+        return failed
+
+    def set_state(self, state):
+        """
+        Changes the state and tells the subscribers about it.
+        """
+        changed = state != self.state
+        now = int(time.time())
+        if self.state:
+            self.energy += 50000.0 * (now - self.last_change)
+        if changed:
+            self.last_change = now
+        self.state = state
+        if changed:
+            with self.lock:
+                subscribers = self.subscribers.items()
+            for sid, url in subscribers:
+                thread = threading.Thread(target=self.notify, args=(sid, url, state))
+                thread.daemon = True
+                thread.start()
+
+    def notify(self, sid, url, state):
+        """
+        Sends a NOTIFY for STATE to the subscriber at URL.
+        """
+        match = re.match(r'http://([^:/]+):(\d+)(/.*)?', url)
+        if not match:
+            return
+        body = NOTIFY_BODY % state
+        try:
+            conn = socket.create_connection((match.group(1), int(match.group(2))), 2.0)
+            conn.sendall('NOTIFY %s HTTP/1.1\r\n' % (match.group(3) or '/') +\
+                         'HOST: %s:%s\r\n' % (match.group(1), match.group(2)) +\
+                         'CONTENT-TYPE: text/xml; charset="utf-8"\r\n' +\
+                         'NT: upnp:event\r\nNTS: upnp:propchange\r\n' +\
+                         'SID: %s\r\nSEQ: 0\r\n' % sid +\
+                         'Content-Length: %d\r\n\r\n' % len(body) + body)
+            conn.recv(1024)
+            conn.close()
+        except socket.error:
+            pass
+
+#} End of FakeWemo
+
+
+
+# Simulator {
+class Simulator(object):
+    """
+    A fleet of simulated devices on the local host, with an SSDP responder that
+    answers M-SEARCH requests sent to it directly.
+    """
+
+    def __init__(self, count, dev_types=("SOCKET",), host='127.0.0.1', ssdp_port=0, faults=None,
+                 spread=0.05):
+        """
+        Creates COUNT devices, cycling through DEV_TYPES. The answers to a search
+        are spread over SPREAD seconds, as real devices wait a random time of up
+        to MX seconds before answering.
+        """
+        self.faults = faults or Faults()
+        self.spread = spread
+        self.devices = [FakeWemo(i, dev_types[i % len(dev_types)], host, self.faults)
+                        for i in range(count)]
+        self.by_fd = dict((dev.sock.fileno(), dev) for dev in self.devices)
+
+        self.ssdp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.ssdp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.ssdp_sock.bind((host, ssdp_port))
+        self.ssdp_address = self.ssdp_sock.getsockname()
+
+        self.stopped = threading.Event()
+
+    def start(self):
+        """
+        Starts serving the devices and answering searches.
+        """
+        for target in (self.accept_loop, self.ssdp_loop):
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def accept_loop(self):
+        """
+        Accepts connections to every device, each connection gets a thread.
+        """
+        socks = [dev.sock for dev in self.devices]
+        while not self.stopped.is_set():
+            readable = select.select(socks, [], [], 0.5)[0]
+            for sock in readable:
+                try:
+                    conn, addr = sock.accept()
+                except socket.error:
+                    continue
+                conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                thread = threading.Thread(target=self.by_fd[sock.fileno()].handle, args=(conn,))
+                thread.daemon = True
+                thread.start()
+
+    def ssdp_loop(self):
+        """
+        Answers M-SEARCH requests for any of the simulated device types.
+        """
+        self.ssdp_sock.settimeout(0.5)
+        while not self.stopped.is_set():
+            try:
+                data, addr = self.ssdp_sock.recvfrom(4096)
+            except socket.timeout:
+                continue
+            st = ST_HEADER_RE.search(data)
+            if not data.startswith('M-SEARCH') or not st:
+                continue
+            st = st.group(1).strip()
+            matches = [dev for dev in self.devices if st in ('ssdp:all', dev.search_target())]
+            for dev in matches:
+                if self.spread:
+                    time.sleep(self.spread / len(matches))
+                if self.faults.dropped():
+                    continue
+                reply = 'HTTP/1.1 200 OK\r\n' +\
+                        'CACHE-CONTROL: max-age=86400\r\n' +\
+                        'EXT:\r\n' +\
+                        'LOCATION: %s\r\n' % dev.location() +\
+                        'SERVER: Unspecified, UPnP/1.0, Unspecified\r\n' +\
+                        'ST: %s\r\n' % dev.search_target() +\
+                        'USN: %s::%s\r\n\r\n' % (dev.udn, dev.search_target())
+                self.ssdp_sock.sendto(reply, addr)
+
+    def describe(self):
+        """
+        Returns a dict with the SSDP address and the devices' locations.
+        """
+        return { "ssdp": list(self.ssdp_address),
+                 "devices": [ { "type": dev.dev_type, "name": dev.name,
+                                "udn": dev.udn, "location": dev.location() }
+                              for dev in self.devices ] }
+
+#} End of Simulator
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Simulate a fleet of WeMo devices.")
+    parser.add_argument("--count", type=int, default=10, help="number of devices")
+    parser.add_argument("--types", default="SOCKET", help="comma separated device types")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--ssdp-port", type=int, default=0, help="port for M-SEARCH requests")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to each response")
+    parser.add_argument("--jitter", type=float, default=0.0, help="random seconds added on top")
+    parser.add_argument("--split", type=int, default=0, help="send responses in pieces of this size")
+    parser.add_argument("--drop", type=float, default=0.0, help="chance a request goes unanswered")
+    parser.add_argument("--slow-fraction", type=float, default=0.0, help="fraction of slow devices")
+    parser.add_argument("--slow-latency", type=float, default=0.0, help="extra seconds for slow devices")
+    parser.add_argument("--spread", type=float, default=0.05, help="seconds the search answers are spread over")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    sim = Simulator(args.count, [t.strip().upper() for t in args.types.split(",")],
+                    args.host, args.ssdp_port,
+                    Faults(args.latency, args.jitter, args.split, args.drop,
+                           args.slow_fraction, args.slow_latency, args.seed),
+                    args.spread)
+    sim.start()
+
+    # Tell whoever started us where the devices are.
+    print json.dumps(sim.describe())
+    sys.stdout.flush()
+
+    signal.signal(signal.SIGTERM, lambda signo, frame: sim.stop())
+    try:
+        while not sim.stopped.is_set():
+            time.sleep(0.5)
+    except KeyboardInterrupt:
+        pass